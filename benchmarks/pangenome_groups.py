@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Pangenome groups benchmark
+
+Times the ortholog groups assembly of PanGenomer (greedy and graph-based)
+on synthetic BBH results (no Blast involved), to check that it scales
+linearly with the number of proteins
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from ductape.genome.pangenome import PanGenomer
+import time
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Classes
+
+class SyntheticPanGenomer(PanGenomer):
+    '''
+    PanGenomer fed with synthetic best hits
+    '''
+    def __init__(self, nproteins, norgs=10):
+        PanGenomer.__init__(self, ['org%d'%i for i in range(norgs)])
+        self._best = {}
+
+        nprots = nproteins / norgs
+        for org in self.organisms:
+            self._orgprots[org] = ['%s_%d'%(org, i) for i in xrange(nprots)]
+            for prot in self._orgprots[org]:
+                self._prot2orgs[prot] = org
+
+        for org in self.organisms:
+            for otherorg in self.organisms:
+                if org == otherorg:
+                    continue
+                # One protein out of five has no ortholog
+                self._best[(org, otherorg)] = dict(
+                                [('%s_%d'%(org, i), '%s_%d'%(otherorg, i))
+                                 for i in xrange(nprots) if i%5 != 0])
+
+    def allBlast(self):
+        return self._best
+
+################################################################################
+# Main
+
+if __name__ == '__main__':
+    print 'method\tproteins\tgroups\tseconds\tus/protein'
+    for method in ('batchBBH', 'graphBBH'):
+        for nproteins in (12500, 25000, 50000, 100000):
+            pang = SyntheticPanGenomer(nproteins)
+            start = time.time()
+            getattr(pang, method)()
+            elapsed = time.time() - start
+            print '%s\t%d\t%d\t%.2f\t%.2f'%(method, nproteins,
+                                        len(pang.groups), elapsed,
+                                        elapsed / nproteins * 1e6)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Search backends benchmark
+
+Times the registered search backends (DB creation and a batched search)
+on synthetic proteomes, to compare new aligners with the default one
+Usage: search_backends.py [backend ...]
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from ductape.genome.blast import Blaster, getBackends, iterTabularHits
+import random
+import shutil
+import tempfile
+import time
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Constants
+
+alphabet = 'ACDEFGHIKLMNPQRSTVWY'
+
+################################################################################
+# Methods
+
+def writeProteome(fname, proteins, rate=0.0):
+    '''
+    Write the proteins (with some random substitutions) to a fasta file
+    '''
+    f = open(fname, 'w')
+    for i, seq in enumerate(proteins):
+        seq = ''.join([random.choice(alphabet) if random.random() < rate
+                       else aa for aa in seq])
+        f.write('>prot%d\n%s\n'%(i, seq))
+    f.close()
+
+################################################################################
+# Main
+
+if __name__ == '__main__':
+    backends = sys.argv[1:]
+    if len(backends) == 0:
+        backends = getBackends()
+    
+    random.seed(42)
+    tmp = tempfile.mkdtemp(prefix='backends_')
+    
+    print 'backend\tproteins\tdb seconds\tsearch seconds\tself hits'
+    for nproteins in (25, 50, 100):
+        proteins = [''.join([random.choice(alphabet)
+                             for j in xrange(random.randint(50, 400))])
+                    for i in xrange(nproteins)]
+        query = os.path.join(tmp, 'query.faa')
+        target = os.path.join(tmp, 'target.faa')
+        writeProteome(query, proteins, 0.2)
+        writeProteome(target, proteins, 0.2)
+        
+        for backend in backends:
+            blaster = Blaster(backend)
+            db = os.path.join(tmp, '%s_db'%backend)
+            
+            start = time.time()
+            if not blaster.createDB(target, 'prot', db):
+                print '%s\t%d\tDB creation failed'%(backend, nproteins)
+                continue
+            dbtime = time.time() - start
+            
+            start = time.time()
+            out = blaster.runBlastPipe(open(query).read(), db, evalue=1e-5,
+                                       additional='-max_target_seqs 5')
+            if out is None:
+                print '%s\t%d\tSearch failed'%(backend, nproteins)
+                continue
+            searchtime = time.time() - start
+            
+            # Queries whose best hit is the same protein
+            found = 0
+            for hits in iterTabularHits(out.splitlines(True), 1e-5):
+                if len(hits) > 0 and hits[0].query_id == hits[0].hit:
+                    found += 1
+            
+            print '%s\t%d\t%.2f\t%.2f\t%d'%(backend, nproteins, dbtime,
+                                            searchtime, found)
+    
+    shutil.rmtree(tmp, True)
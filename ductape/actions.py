@@ -12,8 +12,9 @@ matplotlib.use('Agg')
 #
 from Bio import SeqIO
 from ductape.common.utils import slice_it, rgb_to_hex
-from ductape.phenome.biolog import BiologParser, Plate, getSinglePlates, \
-    BiologZero, zeroPlates, getPlates, Experiment
+from ductape.phenome.biolog import BiologParser, Plate, BiologZero, \
+    zeroPlates, getOrderedSinglePlates, getOrderedPlates, Experiment, \
+    getCubeIndex, writeCube
 from ductape.storage.SQLite.database import DBBase, Project, Genome, Organism, \
     Kegg, Biolog
 from matplotlib import cm
@@ -488,44 +489,47 @@ def dPhenomeZero(project, blankfile=None):
             return False
     
     biolog = Biolog(project)
-    # Fetch the signals to be subtracted, then convert them
-    # to appropriate objects
-    sigs = [s for s in biolog.getZeroSubtractableSignals()]
-    plates = []
-    discarded = set()
-    for p in getSinglePlates(sigs):
-        if p.plate_id in zeroPlates:
-            if blankfile:
-                for zp in bparser.plates:
-                    if zp.plate_id == p.plate_id:
-                        plates.append(p) 
-            else:
-                plates.append(p)
-        else:
-            discarded.add(p.plate_id)
     
-    if len(plates) == 0:
+    # Which plates can be zero subtracted?
+    allowed = set(zeroPlates)
+    if blankfile:
+        allowed = allowed.intersection([zp.plate_id for zp in bparser.plates])
+    
+    candidates = [p for p in biolog.getZeroSubtractablePlates()]
+    discarded = set(candidates).difference(allowed)
+    todo = [p for p in candidates if p in allowed]
+    
+    if len(todo) == 0:
         logger.warning('No plates can be zero subtracted!')
-        logger.warning('Found these plates: %s'%' '.join(discarded))
+        logger.warning('Found these plates: %s'%' '.join(sorted(discarded)))
         return False
     
-    if blankfile:
-        zsub = BiologZero(plates, blank = True, blankData=bparser.plates)
-    else:
-        zsub = BiologZero(plates)
+    # Fetch the signals to be subtracted one plate at a time,
+    # then convert them to appropriate objects and write them back
+    nplates = 0
+    for plate_id in todo:
+        plates = [p for p in getOrderedSinglePlates(
+                            biolog.getZeroSubtractableSignals([plate_id]))]
         
-    if not zsub.zeroSubTract():
-        logger.warning('Zero subtraction failed!')
-        return False
-    
-    # Grep the wells
-    wells = [w for plate in zsub.plates for w in plate.getWells()]
-    
-    # Add to the project
-    biolog = Biolog(project)
-    biolog.addWells(wells, clustered=False)
+        if blankfile:
+            zsub = BiologZero(plates, blank = True, blankData=bparser.plates)
+        else:
+            zsub = BiologZero(plates)
+            
+        if not zsub.zeroSubTract():
+            logger.warning('Zero subtraction failed!')
+            return False
+        
+        # Grep the wells
+        wells = [w for plate in zsub.plates for w in plate.getWells()]
+        
+        # Add to the project
+        biolog.addWells(wells, clustered=False)
+        
+        nplates += len(plates)
+        logger.debug('Zero subtraction done on plate %s'%plate_id)
     
-    logger.info('Zero subtraction done on %d plates'%len(plates))
+    logger.info('Zero subtraction done on %d plates'%nplates)
     if biolog.atLeastOneParameter():
         logger.warning('The activity must be recalculated')
     
@@ -534,14 +538,9 @@ def dPhenomeZero(project, blankfile=None):
 def dPhenomePurge(project, policy, delta=1, filterplates=[]):
     biolog = Biolog(project)
     
-    sigs = [s for s in biolog.getAllWells()]
-    plates = [p for p in getPlates(sigs, nonmean=True)]
     # The user may want to purge only some plates
-    if len(filterplates) > 0:
-        for p in plates:
-            if p.plate_id not in filterplates:
-                while p in plates:
-                    plates.remove(p)
+    plates = [p for p in getOrderedPlates(biolog.getAllWells(filterplates),
+                                          nonmean=True)]
     isZero = biolog.atLeastOneZeroSubtracted()
 
     if len(plates) == 0:
@@ -691,6 +690,10 @@ def dGenomeStats(project, svg=False, doPrint=True):
             
             muts = [x for x in organism.getOrgMutants(ref_id)]
             
+            # Reference figures, computed once for all its mutants
+            refstats = (genome.howMany(ref_id), kegg.howManyMapped(ref_id),
+                        kegg.howManyReactions(ref_id))
+            
             lOrg = []
             for org_id in [ref_id] + muts:
                 org = organism.getOrg(org_id)
@@ -700,22 +703,22 @@ def dGenomeStats(project, svg=False, doPrint=True):
                 
                 mkind = org.mkind if org.mkind in ['deletion', 'insertion'] else 'wild-type'
                 
-                if mkind not in ['deletion', 'insertion']:
-                    prots = genome.howMany(org_id)
-                elif mkind == 'deletion':
-                    prots = genome.howMany(ref_id) - genome.howMany(org_id)
-                elif mkind == 'insertion':
-                    prots = genome.howMany(ref_id) + genome.howMany(org_id)
+                if org_id == ref_id:
+                    prots, mapped, react = refstats
+                else:
+                    # Only the mutated proteins are counted
+                    prots, mapped, react = (genome.howMany(org_id),
+                                            kegg.howManyMapped(org_id),
+                                            kegg.howManyReactions(org_id))
                 
-                mapped, react = (kegg.howManyMapped(org_id),
-                                kegg.howManyReactions(org_id))
-        
                 if mkind == 'deletion':
-                    mapped = kegg.howManyMapped(ref_id) - mapped
-                    react = kegg.howManyReactions(ref_id) - react
+                    prots, mapped, react = [r - m for r, m in
+                                            zip(refstats,
+                                                (prots, mapped, react))]
                 elif mkind == 'insertion':
-                    mapped += kegg.howManyMapped(ref_id)
-                    react += kegg.howManyReactions(ref_id)
+                    prots, mapped, react = [r + m for r, m in
+                                            zip(refstats,
+                                                (prots, mapped, react))]
                 
                 stats = '\t'.join( [str(x) for x in [org_id, name, description,
                                                  mkind, prots, mapped,
@@ -834,6 +837,27 @@ def dGenomeExport(project):
     
     return True
             
+def dPhenomeExportCube(project, prefix='phenome_cube'):
+    '''
+    Export the phenomic signals as a memory-mappable numpy array
+    (plate x well x strain x replica x time) plus its index
+    '''
+    biolog = Biolog(project, profile='read')
+    
+    index = getCubeIndex(biolog.getAllSignals())
+    if not index:
+        logger.info('No phenomic data can be exported at this time')
+        return False
+    
+    logger.info('Exporting phenomic signals')
+    
+    shape = writeCube(biolog.getAllSignals(), index, prefix)
+    
+    logger.info('Saved a %s signal cube (%s.npy, %s_index.npz)'%
+                (' x '.join([str(x) for x in shape]), prefix, prefix))
+    
+    return True
+            
 def dSetKind(project):
     '''
     Set the kind of genomic project and return its value
@@ -1107,6 +1131,35 @@ def touchProject(project):
         logger.debug('%s'%str(proj))
         return True
 
+def prepareProteome(project, org_id, fname):
+    '''
+    Export the proteome of an organism in fasta format
+    The file is rewritten only if the proteome has changed since
+    the last export (a checksum is kept in fname.sha1)
+    '''
+    gen = Genome(project)
+    
+    checksum = gen.getProteomeChecksum(org_id)
+    checkfile = fname + '.sha1'
+    if os.path.exists(fname) and os.path.exists(checkfile):
+        if open(checkfile).read().strip() == checksum:
+            logger.debug('Proteome of %s has not changed'%org_id)
+            return True
+    
+    try:
+        tmpname = fname + '.tmp'
+        nprots = gen.writeProteome(org_id, tmpname)
+        os.rename(tmpname, fname)
+        fcheck = open(checkfile, 'w')
+        fcheck.write(checksum + '\n')
+        fcheck.close()
+    except Exception, e:
+        logger.error('Could not export the proteome of %s (%s)'%(org_id, e))
+        return False
+    
+    logger.debug('Exported %d proteins for %s'%(nprots, org_id))
+    return True
+
 def prepareDir(wdir, tdir):
     '''
     Prepare the temp directory
@@ -153,9 +153,11 @@ class CommonMultiProcess(CommonThread):
         self._unique += 1
         return self._unique
     
-    def initiateParallel(self):
+    def initiateParallel(self, nprocs=None):
+        if not nprocs:
+            nprocs = self.ncpus
         self._parallel = [Consumer(self._paralleltasks,self._parallelresults)
-                          for x in range(self.ncpus)]
+                          for x in range(nprocs)]
         for consumer in self._parallel:
             consumer.start()
             
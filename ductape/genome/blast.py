@@ -6,10 +6,18 @@ Genome library
 
 Classes to handle Blast analysis against a local database
 """
+from collections import namedtuple
+import atexit
+import hashlib
 import logging
 import os
+import re
+import shutil
+import socket
 import subprocess
 import sys
+import tempfile
+import time
 
 __author__ = "Marco Galardini"
 
@@ -18,6 +26,29 @@ __author__ = "Marco Galardini"
 
 logger = logging.getLogger('ductape.blast')
 
+################################################################################
+# Constants
+
+# Tabular output columns, same order as the TabularHit fields
+tabcolumns = 'qseqid sseqid qlen slen evalue bitscore stitle'
+tabformat = '6 %s'%tabcolumns
+
+# Fasta indexes, shared by the forked worker processes
+_indexes = {}
+
+# Blast DBs cache, shared across runs and projects
+cachedir = os.path.join(os.path.expanduser('~'), '.ductape', 'blastdb')
+# Environment variable overriding the cache location (empty to disable it)
+cacheenv = 'DUCTAPE_BLASTDB'
+# Maximum cache size (bytes)
+cachesize = 10 * 1024 * 1024 * 1024
+# Leases held by other hosts are trusted for this long (seconds)
+leasetime = 24 * 3600
+
+# Search backends: name --> SearchBackend subclass (or its import path)
+_backends = {'blast':'ductape.genome.blast.BlastPlusBackend',
+             'sw':'ductape.genome.smithwaterman.SmithWatermanBackend'}
+
 ################################################################################
 # Classes
 
@@ -80,14 +111,405 @@ class BlastHit:
         else:
             return None
         
-class Blaster(object):
-    def __init__(self):
-        self._hits = None
-        self._out = ''
+class TabularHit(namedtuple('TabularHit', ['query_id', 'hit',
+                                             'query_len', 'hit_len',
+                                             'evalue', 'bits',
+                                             'hit_desc'])):
+    '''
+    Lightweight hit, derived from a tabular Blast output
+    Has the same attribute names of BlastHit
+    '''
+    __slots__ = ()
+    
+    def getKO(self):
+        '''
+        Assuming that this hit derives from a KEGG DB
+        Returns the KO ID
+        '''
+        a=re.search("K[0-9]{1,}",
+                    self.hit_desc)
+        if a is not None:
+            return a.group()
+        else:
+            return None
+
+class FastaIndex(object):
+    '''
+    Sequence ID --> file offset map of a fasta file
+    The file is opened at each access, so that the index can be safely
+    inherited by forked worker processes
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+        # Sequence IDs, in file order
+        self.ids = []
+        self._offsets = {}
         
-    def createDB(self,seqFile,dbType,outFile='BlastDB',parseIDs=True,
-                        title='Generic Blast DB'):
-        '''Generation of a Blast DB'''
+        self._build()
+    
+    def _build(self):
+        offset = 0
+        start = 0
+        current = None
+        for l in open(self.fname, 'rb'):
+            if l.startswith('>'):
+                if current is not None and current not in self._offsets:
+                    self._offsets[current] = (start, offset - start)
+                try:
+                    current = l[1:].split(None, 1)[0]
+                except IndexError:
+                    current = ''
+                start = offset
+                self.ids.append(current)
+            offset += len(l)
+        if current is not None and current not in self._offsets:
+            self._offsets[current] = (start, offset - start)
+    
+    def __contains__(self, seqid):
+        return seqid in self._offsets
+    
+    def __len__(self):
+        return len(self._offsets)
+    
+    def getRaw(self, seqid):
+        '''
+        Get the fasta record as a string
+        '''
+        start, length = self._offsets[seqid]
+        f = open(self.fname, 'rb')
+        f.seek(start)
+        raw = f.read(length)
+        f.close()
+        return raw
+    
+    def getRecord(self, seqid):
+        '''
+        Get the fasta record as a Biopython SeqRecord
+        '''
+        from Bio import SeqIO
+        from StringIO import StringIO
+        return SeqIO.read(StringIO(self.getRaw(seqid)), 'fasta')
+    
+    def writeSequence(self, seqid, out):
+        '''
+        Write the fasta record to a file
+        '''
+        f = open(out, 'wb')
+        f.write(self.getRaw(seqid))
+        f.close()
+
+def iterTabularHits(lines, expect=10.0):
+    '''
+    Parse the lines of a tabular Blast output (outfmt 6 or 7,
+    using tabcolumns)
+    Returns a Generator query -> TabularHit list
+    Queries without hits are not reported
+    NB it is a generator
+    '''
+    query = None
+    hits = []
+    for l in lines:
+        if l.startswith('#'):
+            continue
+        s = l.rstrip('\n').split('\t')
+        if len(s) < 7:
+            continue
+        if s[0] != query:
+            if query is not None:
+                yield hits
+            query = s[0]
+            hits = []
+        evalue = float(s[4])
+        if evalue > expect:continue
+        hits.append(TabularHit(s[0], s[1], int(s[2]), int(s[3]),
+                               evalue, float(s[5]), '\t'.join(s[6:])))
+    if query is not None:
+        yield hits
+
+def stripLocalID(seqid):
+    '''
+    Remove the "lcl|" prefix Blast+ may add to the sequence IDs
+    '''
+    return seqid.replace('lcl|','')
+
+def getBlastDBCache(location=None, maxsize=cachesize):
+    '''
+    Open the Blast DBs cache (None if disabled)
+    The location defaults to $DUCTAPE_BLASTDB, then to ~/.ductape/blastdb
+    '''
+    if location is None:
+        location = os.environ.get(cacheenv, cachedir)
+    if not location:
+        return None
+    return BlastDBCache(os.path.expanduser(location), maxsize)
+
+def getFastaIndex(fname):
+    '''
+    Get the index of a fasta file, building it the first time
+    '''
+    fname = os.path.abspath(fname)
+    if fname not in _indexes:
+        _indexes[fname] = FastaIndex(fname)
+    return _indexes[fname]
+
+class BlastDBCache(object):
+    '''
+    Content-addressed cache of Blast DBs
+    Each DB is stored in a directory named after the SHA-256 of the fasta
+    file and the DB options; the least recently used DBs are
+    removed when the cache exceeds the maximum size
+    A DB handed out is leased to the process until it exits, so that
+    the DBs used by concurrent runs are never removed
+    '''
+    def __init__(self, location=cachedir, maxsize=cachesize):
+        self.location = location
+        self.maxsize = int(maxsize)
+        # Leases held by this process
+        self._leases = set()
+    
+    def getKey(self, seqFile, options):
+        '''
+        SHA-256 of the fasta file plus the DB options
+        '''
+        h = hashlib.sha256()
+        f = open(seqFile, 'rb')
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            h.update(chunk)
+        f.close()
+        h.update(options)
+        return h.hexdigest()
+    
+    def _getSize(self, path):
+        size = 0
+        for root, dirs, files in os.walk(path):
+            for fname in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, fname))
+                except OSError:pass
+        return size
+    
+    def _getUsed(self, key):
+        return os.path.join(self.location, key, 'used')
+    
+    def _getLease(self, path):
+        return os.path.join(path, 'lease.%s.%d'%(socket.gethostname(),
+                                                 os.getpid()))
+    
+    def lease(self, key):
+        '''
+        Lease the DB to this process; the lease is released at exit
+        Returns False if the DB is not (or no longer) in the cache
+        '''
+        lease = self._getLease(os.path.join(self.location, key))
+        try:
+            open(lease, 'w').close()
+        except IOError:
+            return False
+        if not os.path.exists(self._getUsed(key)):
+            # Evicted in the meantime
+            self.release(lease)
+            return False
+        if lease not in self._leases:
+            self._leases.add(lease)
+            atexit.register(self.release, lease)
+        return True
+    
+    def release(self, lease):
+        try:
+            os.remove(lease)
+        except OSError:pass
+        self._leases.discard(lease)
+    
+    def isLeased(self, path):
+        '''
+        Check for valid leases on a DB directory, removing the stale ones
+        (processes on this host that are no longer running)
+        '''
+        host = socket.gethostname()
+        leased = False
+        for fname in os.listdir(path):
+            if not fname.startswith('lease.'):
+                continue
+            lease = os.path.join(path, fname)
+            lhost, pid = fname[6:].rsplit('.', 1)
+            if lhost == host:
+                try:
+                    os.kill(int(pid), 0)
+                except (OSError, ValueError):
+                    self.release(lease)
+                    continue
+            else:
+                try:
+                    if time.time() - os.path.getmtime(lease) > leasetime:
+                        continue
+                except OSError:
+                    continue
+            leased = True
+        return leased
+    
+    def getDB(self, seqFile, dbType, parseIDs=True, title='Generic Blast DB',
+              backend='blast'):
+        '''
+        Get the path of the Blast DB of the fasta file, creating it
+        if it's not in the cache
+        Returns None if something went wrong
+        '''
+        options = ' '.join([dbType, str(bool(parseIDs)), title, backend])
+        key = self.getKey(seqFile, options)
+        db = os.path.join(self.location, key, 'db')
+        
+        if os.path.exists(self._getUsed(key)) and self.lease(key):
+            logger.debug('Blast DB for %s found in cache (%s)'%(seqFile, key))
+            os.utime(self._getUsed(key), None)
+            return db
+        
+        try:
+            if not os.path.exists(self.location):
+                os.makedirs(self.location)
+        except OSError:
+            logger.warning('Could not create the Blast DB cache %s'%
+                           self.location)
+            return None
+        
+        # Build in a private directory, then move it in place
+        tmpdir = os.path.join(self.location, '%s.%d.tmp'%(key, os.getpid()))
+        shutil.rmtree(tmpdir, True)
+        os.mkdir(tmpdir)
+        if not Blaster(backend).createDB(seqFile, dbType,
+                                         os.path.join(tmpdir, 'db'),
+                                         parseIDs, title):
+            shutil.rmtree(tmpdir, True)
+            return None
+        open(os.path.join(tmpdir, 'used'), 'w').close()
+        try:
+            os.rename(tmpdir, os.path.join(self.location, key))
+        except OSError:
+            # Someone else was faster
+            shutil.rmtree(tmpdir, True)
+            if not os.path.exists(self._getUsed(key)):
+                return None
+        if not self.lease(key):
+            return None
+        
+        self.evict()
+        
+        return db
+    
+    def evict(self):
+        '''
+        Remove the least recently used DBs until the cache fits
+        in the maximum size; leased DBs are kept
+        '''
+        entries = []
+        total = 0
+        for key in os.listdir(self.location):
+            # DBs being built or removed
+            if '.' in key:
+                continue
+            used = self._getUsed(key)
+            if not os.path.exists(used):
+                continue
+            size = self._getSize(os.path.join(self.location, key))
+            entries.append((os.path.getmtime(used), key, size))
+            total += size
+        
+        for mtime, key, size in sorted(entries):
+            if total <= self.maxsize:
+                break
+            path = os.path.join(self.location, key)
+            if self.isLeased(path):
+                continue
+            # Moved away first: a lease taken meanwhile shows up there
+            trash = os.path.join(self.location, '%s.%d.del'%(key,
+                                                            os.getpid()))
+            try:
+                os.rename(path, trash)
+            except OSError:
+                continue
+            if self.isLeased(trash):
+                try:
+                    os.rename(trash, path)
+                except OSError:pass
+                continue
+            logger.debug('Removing Blast DB %s from cache'%key)
+            shutil.rmtree(trash, True)
+            total -= size
+
+class SearchBackend(object):
+    '''
+    Sequence search backend used by Blaster
+    A backend creates the search DBs, searches batches of query
+    sequences (tabular output, see tabcolumns) and retrieves the DB
+    sequences; other aligners can be plugged in with registerBackend
+    Temporary files go to the scratch location, if set
+    '''
+    scratch = None
+    
+    def createDB(self, seqFile, dbType, outFile, parseIDs=True,
+                 title='Generic Blast DB'):
+        '''
+        Create a search DB from a fasta file
+        '''
+        raise NotImplementedError
+    
+    def search(self, queryFile, db, outFile, evalue=10, task='', ncpus=1,
+               additional='', outfmt=tabformat):
+        '''
+        Search the sequences of a fasta file against a DB,
+        writing the results to outFile
+        '''
+        raise NotImplementedError
+    
+    def searchPipe(self, query, db, evalue=10, task='', ncpus=1,
+                   additional='', outfmt=tabformat):
+        '''
+        Search the query sequences (fasta string) against a DB
+        Returns the output as a string, None if something went wrong
+        Temporary files are used, unless the backend knows better
+        '''
+        tmpdir = tempfile.mkdtemp(prefix='search_', dir=self.scratch)
+        try:
+            queryFile = os.path.join(tmpdir, 'query.faa')
+            outFile = os.path.join(tmpdir, 'out.tab')
+            fquery = open(queryFile, 'w')
+            fquery.write(query)
+            fquery.close()
+            if not self.search(queryFile, db, outFile, evalue, task, ncpus,
+                               additional, outfmt):
+                return None
+            return open(outFile).read()
+        finally:
+            shutil.rmtree(tmpdir, True)
+    
+    def fetchSequence(self, db, accession):
+        '''
+        Get a sequence from a DB, as a fasta string
+        Returns None if something went wrong
+        '''
+        raise NotImplementedError
+    
+    def fetchSequences(self, db, accessions):
+        '''
+        Get many sequences from a DB, as a dictionary
+        accession --> fasta string
+        The accessions that could not be retrieved are not reported
+        '''
+        seqs = {}
+        for accession in accessions:
+            seq = self.fetchSequence(db, accession)
+            if seq is not None:
+                seqs[accession] = seq
+        return seqs
+
+class BlastPlusBackend(SearchBackend):
+    '''
+    NCBI Blast+ backend (makeblastdb, blastp, blastdbcmd)
+    '''
+    def createDB(self, seqFile, dbType, outFile, parseIDs=True,
+                 title='Generic Blast DB'):
         cmd = ('makeblastdb -in %s -dbtype %s -out %s -title "%s"')
         cmd = cmd%(seqFile,dbType,outFile,title)
         if parseIDs:
@@ -104,41 +526,26 @@ class Blaster(object):
 
         return bool(not return_code)
     
-    def retrieveFromDB(self, db, accession, out='out.fsa', isFile=False):
-        '''Retrieve the desired sequence(s) from a Blast DB'''
-        if not isFile:
-            cmd=('blastdbcmd -db %s -entry "%s" > %s'
-                 %(db,accession,out))
-        else:
-            cmd=('blastdbcmd -db %s -entry_batch "%s" > %s'
-                 %(db,accession,out))
-        logger.debug('BlastDBcmd cmd: %s'%cmd)
-        proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
-                    stdin=subprocess.PIPE,stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-        out = proc.communicate()
-        return_code = proc.returncode
-        if return_code != 0:
-            logger.warning('BlastDBcmd failed with error %d'
-                            %return_code)
-
-        return bool(not return_code)
-    
-    def runBlast(self, queryFile, db, outFile, evalue = 10,
-                    task = '', ncpus = 1, additional = ''):
-        '''Run Blast with the desired parameters'''
+    def _getBlastCmd(self, queryFile, db, outFile, evalue, task, ncpus,
+                     additional, outfmt):
         # Create the command line
         from Bio.Blast.Applications import NcbiblastpCommandline
-        self._out = outFile
         cmd = NcbiblastpCommandline(query=queryFile, db=db,
                 evalue=float(evalue),
-                outfmt='5',out=outFile,
+                outfmt=outfmt,
                 num_threads=ncpus)
+        if outFile is not None:
+            cmd.set_parameter('out', outFile)
         if task != '':
             cmd.set_parameter('task', task)
         if additional !='':
             cmd = str(cmd)+' '+additional
-        cmd=str(cmd)
+        return str(cmd)
+    
+    def search(self, queryFile, db, outFile, evalue=10, task='', ncpus=1,
+               additional='', outfmt=tabformat):
+        cmd = self._getBlastCmd(queryFile, db, outFile, evalue, task, ncpus,
+                                additional, outfmt)
         logger.debug('Run Blast cmd: %s'%cmd)
         # Run Blast and check the return code
         proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
@@ -152,6 +559,199 @@ class Blaster(object):
 
         return bool(not return_code)
     
+    def searchPipe(self, query, db, evalue=10, task='', ncpus=1,
+                   additional='', outfmt=tabformat):
+        # The query sequences are sent through stdin
+        cmd = self._getBlastCmd('-', db, None, evalue, task, ncpus,
+                                additional, outfmt)
+        logger.debug('Run Blast cmd: %s'%cmd)
+        # Run Blast and check the return code
+        proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
+                    stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+        out = proc.communicate(query)
+        return_code = proc.returncode
+        if return_code != 0:
+            logger.warning('Run Blast failed with error %d'
+                            %return_code)
+            return None
+        
+        return out[0]
+    
+    def fetchSequence(self, db, accession):
+        cmd = 'blastdbcmd -db %s -entry "%s"'%(db,accession)
+        logger.debug('BlastDBcmd cmd: %s'%cmd)
+        proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
+                    stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+        out = proc.communicate()
+        return_code = proc.returncode
+        if return_code != 0:
+            logger.warning('BlastDBcmd failed with error %d'
+                            %return_code)
+            return None
+        
+        return out[0]
+    
+    def fetchSequences(self, db, accessions):
+        # A single blastdbcmd run for all the entries
+        if len(accessions) == 0:
+            return {}
+        
+        fentries, entries = tempfile.mkstemp(suffix='.txt', dir=self.scratch)
+        os.write(fentries, ''.join(['%s\n'%x for x in accessions]))
+        os.close(fentries)
+        try:
+            cmd = 'blastdbcmd -db %s -entry_batch "%s"'%(db,entries)
+            logger.debug('BlastDBcmd cmd: %s'%cmd)
+            proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
+                        stdin=subprocess.PIPE,stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+            out = proc.communicate()
+            return_code = proc.returncode
+        finally:
+            os.remove(entries)
+        if return_code != 0:
+            logger.warning('BlastDBcmd failed with error %d'
+                            %return_code)
+            return {}
+        
+        wanted = dict([(stripLocalID(x), x) for x in accessions])
+        seqs = {}
+        for record in out[0].split('\n>'):
+            record = record.lstrip('>')
+            if record.strip() == '':
+                continue
+            seqid = stripLocalID(record.split(None, 1)[0])
+            if seqid in wanted:
+                seqs[wanted[seqid]] = '>' + record.rstrip('\n') + '\n'
+        
+        # Entries whose ID has been rewritten by blastdbcmd
+        for accession in accessions:
+            if accession not in seqs:
+                seq = self.fetchSequence(db, accession)
+                if seq is not None:
+                    seqs[accession] = seq
+        return seqs
+
+def registerBackend(name, backend):
+    '''
+    Register a search backend, either a SearchBackend subclass
+    or its import path (i.e. 'mypackage.mymodule.MyBackend')
+    '''
+    _backends[name] = backend
+
+def getBackends():
+    '''
+    Names of the registered search backends
+    '''
+    return sorted(_backends)
+
+def getBackend(name='blast'):
+    '''
+    Get an instance of a registered search backend
+    '''
+    if name not in _backends:
+        raise ValueError('Unknown search backend %s'%name)
+    backend = _backends[name]
+    if isinstance(backend, basestring):
+        module, cls = backend.rsplit('.', 1)
+        backend = getattr(__import__(module, fromlist=[cls]), cls)
+        _backends[name] = backend
+    return backend()
+
+class Blaster(object):
+    '''
+    Sequence searches, using one of the registered backends
+    (NCBI Blast+ by default)
+    '''
+    def __init__(self, backend='blast', scratch=None):
+        self._hits = None
+        self._out = ''
+        self.backendname = backend
+        self.backend = getBackend(backend)
+        # Backend temporary files location
+        self.backend.scratch = scratch
+        
+    def createDB(self,seqFile,dbType,outFile='BlastDB',parseIDs=True,
+                        title='Generic Blast DB'):
+        '''Generation of a Blast DB'''
+        return self.backend.createDB(seqFile, dbType, outFile, parseIDs,
+                                     title)
+    
+    def createCachedDB(self, seqFile, dbType, outFile='BlastDB',
+                       parseIDs=True, title='Generic Blast DB', cache=None):
+        '''
+        Get the Blast DB from the cache, creating it if needed
+        If the cache can't be used, the DB is created in outFile
+        Returns the DB path, or None if the DB could not be created
+        '''
+        if cache is None:
+            cache = getBlastDBCache()
+        if cache is not None:
+            db = cache.getDB(seqFile, dbType, parseIDs, title,
+                             self.backendname)
+            if db is not None:
+                return db
+        
+        logger.debug('Blast DB cache not used for %s'%seqFile)
+        if not self.createDB(seqFile, dbType, outFile, parseIDs, title):
+            return None
+        return outFile
+    
+    def fetchSequence(self, db, accession, fasta=None):
+        '''
+        Get a sequence (as a fasta string) from the fasta file index,
+        if available; the search backend is used otherwise
+        Returns None if something went wrong
+        '''
+        if fasta is not None:
+            index = getFastaIndex(fasta)
+            seqid = stripLocalID(accession)
+            if seqid in index:
+                return index.getRaw(seqid)
+        
+        return self.backend.fetchSequence(db, accession)
+    
+    def fetchSequences(self, db, accessions, fasta=None):
+        '''
+        Get many sequences, as a dictionary accession --> fasta string
+        The fasta file index is used first (if available), the missing
+        sequences are retrieved from the DB with a single backend call
+        The accessions that could not be retrieved are not reported
+        '''
+        seqs = {}
+        missing = []
+        if fasta is not None:
+            index = getFastaIndex(fasta)
+        for accession in accessions:
+            seqid = stripLocalID(accession)
+            if fasta is not None and seqid in index:
+                seqs[accession] = index.getRaw(seqid)
+            else:
+                missing.append(accession)
+        
+        if len(missing) > 0:
+            seqs.update(self.backend.fetchSequences(db, missing))
+        return seqs
+    
+    def runBlast(self, queryFile, db, outFile, evalue = 10,
+                    task = '', ncpus = 1, additional = '', outfmt = '5'):
+        '''Run Blast with the desired parameters'''
+        self._out = outFile
+        return self.backend.search(queryFile, db, outFile, evalue, task,
+                                   ncpus, additional, outfmt)
+    
+    def runBlastPipe(self, query, db, evalue = 10,
+                    task = '', ncpus = 1, additional = '', outfmt = tabformat):
+        '''
+        Run Blast with the desired parameters, without temporary files:
+        the query sequences (fasta string) are sent through stdin
+        Returns the Blast output as a string, None if something went wrong
+        '''
+        return self.backend.searchPipe(query, db, evalue, task, ncpus,
+                                       additional, outfmt)
+    
     def parseBlast(self, fileOut):
         '''Parse the xml blast output -- default file is self._out'''
         from Bio.Blast import NCBIXML
@@ -172,12 +772,30 @@ class Blaster(object):
                     h=BlastHit(BlastQuery,alignment,hsp)
                     hits.append(h)
             yield hits
+    
+    def getTabularHits(self, fileOut=None, expect=10.0):
+        '''
+        Parse a tabular Blast output (outfmt 6 or 7, using tabcolumns)
+        Returns a Generator query -> TabularHit list
+        Queries without hits are not reported
+        NB it is a generator
+        '''
+        if fileOut is None:
+            fileOut = self._out
+        for hits in iterTabularHits(open(fileOut), expect):
+            yield hits
             
 class RunBBH(object):
+    '''
+    Blast BBH of a single query
+    Sequences and Blast outputs are kept in memory (stdin/stdout)
+    '''
     def __init__(self, query, queryid,
                  source, target, targetorg,
                  evalue, matrix, short = False, uniqueid = 1,
-                 kegg = False, ko_entry = None, ko_id = None):
+                 kegg = False, ko_entry = None, ko_id = None,
+                 targetfasta = None, queryseq = None, backend = 'blast',
+                 scratch = None):
         self.query = query
         self.queryid = queryid
         self.source = source
@@ -190,27 +808,32 @@ class RunBBH(object):
         self.kegg = kegg
         self.ko_entry = ko_entry
         self.ko_id = ko_id
+        # Target sequences are taken from here, if provided
+        self.targetfasta = targetfasta
+        # Query sequence (fasta string), read from the query file if missing
+        self.queryseq = queryseq
         
-        self.out = self.query + '_' + str(self.uniqueid) +'.xml'
-        self.blaster = Blaster()
+        self.blaster = Blaster(backend, scratch)
         self.additional = (' -soft_masking true -dbsize 500000000 '+
-                    '-use_sw_tback -num_alignments 1 -matrix %s'%self.matrix)
-        self.queryreturn = self.query + '_' + str(self.uniqueid) + '_return'
+                    '-use_sw_tback -max_target_seqs 5 -matrix %s'%self.matrix)
     
     def _firstRun(self):
+        if self.queryseq is None:
+            self.queryseq = open(self.query).read()
+        
         if self.short:
-            res = self.blaster.runBlast(self.query, self.target, self.out,
+            out = self.blaster.runBlastPipe(self.queryseq, self.target,
                          evalue = self.evalue,
                          task='blastp-short',
                          additional=self.additional)
         else:
-            res = self.blaster.runBlast(self.query, self.target, self.out,
+            out = self.blaster.runBlastPipe(self.queryseq, self.target,
                          evalue = self.evalue,
                          additional = self.additional)
         
-        return res
+        return out
     
-    def _secondRun(self, hit_len = None):
+    def _secondRun(self, queryreturn, hit_len = None):
         # Second Blast run
         if not hit_len:
             if self.short:
@@ -218,78 +841,154 @@ class RunBBH(object):
             else:
                 hit_len = 100
         if hit_len < 30:
-            res = self.blaster.runBlast(self.queryreturn, self.source, self.out,
+            out = self.blaster.runBlastPipe(queryreturn, self.source,
                      evalue = self.evalue,
                      task='blastp-short',
                      additional=self.additional)
         else:
-            res = self.blaster.runBlast(self.queryreturn, self.source, self.out,
+            out = self.blaster.runBlastPipe(queryreturn, self.source,
                      evalue = self.evalue,
                      additional=self.additional)
             
-        return res
+        return out
     
     def __call__(self):
         if not self.kegg:
             # First Blast run
-            res = self._firstRun()
+            out = self._firstRun()
             
-            if not res:
-                try:
-                    os.remove(self.out)
-                except:pass
+            if out is None:
                 return (None, self.targetorg, False)
             
-            self.blaster.parseBlast(self.out)
-            for hits in self.blaster.getHits(self.evalue):
+            queryreturn = None
+            for hits in iterTabularHits(out.splitlines(True), self.evalue):
                 if len(hits) == 0:
                     break
                 targethit = hits[0]
     
-                if not self.blaster.retrieveFromDB(self.target, targethit.hit,
-                                      out=self.queryreturn):
-                    try:
-                        os.remove(self.out)
-                    except:pass
+                queryreturn = self.blaster.fetchSequence(self.target,
+                                      targethit.hit,
+                                      fasta=self.targetfasta)
+                if queryreturn is None:
                     return (None, self.targetorg, False)
     
                 # Second Blast run            
-                res = self._secondRun(targethit.hit_len)
+                out = self._secondRun(queryreturn, targethit.hit_len)
                 break
+            
+            if queryreturn is None:
+                # No hits at all
+                return (None, self.targetorg, True)
         else:
-            if not self.blaster.retrieveFromDB(self.target, self.ko_entry,
-                                      out=self.queryreturn):
-                try:
-                    os.remove(self.out)
-                except:
-                    pass
+            queryreturn = self.blaster.fetchSequence(self.target,
+                                      self.ko_entry,
+                                      fasta=self.targetfasta)
+            if queryreturn is None:
                 return (None, self.targetorg, False)
-            res = self._secondRun()
+            out = self._secondRun(queryreturn)
         
-        if not res:
-            try:
-                os.remove(self.out)
-                os.remove(self.queryreturn)
-            except:pass
+        if out is None:
             return (None, self.targetorg, False)
         
-        self.blaster.parseBlast(self.out)
-        for hits in self.blaster.getHits(self.evalue):
+        for hits in iterTabularHits(out.splitlines(True), self.evalue):
             if len(hits) == 0:
                 return (None, self.targetorg, True)
             sourcehit = hits[0]
             if self.queryid == sourcehit.hit:
-                os.remove(self.out)
-                os.remove(self.queryreturn)
                 if self.kegg:
                     return (self.ko_id,self.queryid, True)
                 else:
-                    return (sourcehit.query_id.replace('lcl|',''),
+                    return (stripLocalID(sourcehit.query_id),
                         self.targetorg, True)
             else:
-                os.remove(self.out)
-                os.remove(self.queryreturn)
                 return (None, self.targetorg, True)
 
-        os.remove(self.out)
-        return (None, self.targetorg, True)
\ No newline at end of file
+        return (None, self.targetorg, True)
+
+class RunTagged(object):
+    '''
+    Wraps a Blast task, so that results coming from a shared
+    worker pool can be assigned to the right query
+    '''
+    def __init__(self, tag, task):
+        self.tag = tag
+        self.task = task
+    
+    def __call__(self):
+        return (self.tag, self.task())
+
+class RunAllBlast(object):
+    '''
+    Blast a whole proteome against a Blast DB in a single run
+    Tabular output is used, the best hits are parsed later
+    '''
+    def __init__(self, query, target, sourceorg, targetorg, out,
+                 evalue, matrix, short = False, ncpus = 1, backend = 'blast'):
+        self.query = query
+        self.target = target
+        self.sourceorg = sourceorg
+        self.targetorg = targetorg
+        self.out = out
+        self.evalue = evalue
+        self.matrix = matrix
+        self.short = short
+        self.ncpus = ncpus
+        
+        self.blaster = Blaster(backend)
+        self.additional = (' -soft_masking true -dbsize 500000000 '+
+                    '-use_sw_tback -max_target_seqs 5 -matrix %s'%self.matrix)
+        self.outfmt = tabformat
+    
+    def __call__(self):
+        # The output file is present only if Blast was successful
+        tmpout = self.out + '.tmp'
+        if self.short:
+            res = self.blaster.runBlast(self.query, self.target, tmpout,
+                         evalue = self.evalue,
+                         task='blastp-short',
+                         ncpus = self.ncpus,
+                         additional=self.additional,
+                         outfmt = self.outfmt)
+        else:
+            res = self.blaster.runBlast(self.query, self.target, tmpout,
+                         evalue = self.evalue,
+                         ncpus = self.ncpus,
+                         additional=self.additional,
+                         outfmt = self.outfmt)
+        
+        if res:
+            os.rename(tmpout, self.out)
+        
+        return (self.sourceorg, self.targetorg, self.out, res)
+
+class RunSliceBlast(object):
+    '''
+    Blast a slice of a query against a Blast DB
+    Each slice can use more than one thread
+    '''
+    def __init__(self, query, db, out, evalue, short = False, ncpus = 1,
+                 outfmt = tabformat, backend = 'blast'):
+        self.query = query
+        self.db = db
+        self.out = out
+        self.evalue = evalue
+        self.short = short
+        self.ncpus = ncpus
+        self.outfmt = outfmt
+        
+        self.blaster = Blaster(backend)
+    
+    def __call__(self):
+        if self.short:
+            res = self.blaster.runBlast(self.query, self.db, self.out,
+                         evalue = self.evalue,
+                         task='blastp-short',
+                         ncpus = self.ncpus,
+                         outfmt = self.outfmt)
+        else:
+            res = self.blaster.runBlast(self.query, self.db, self.out,
+                         evalue = self.evalue,
+                         ncpus = self.ncpus,
+                         outfmt = self.outfmt)
+        
+        return (self.query, self.out, res)
@@ -7,10 +7,13 @@ Genome library
 Handle a KO search on a local machine (Blast-BBH) or online (KAAS)
 """
 from Bio import SeqIO
-from ductape.common.commonmultiprocess import CommonMultiProcess
+from ductape.common.commonmultiprocess import CommonMultiProcess, SafeSleep
+from ductape.common.commonthread import CommonThread
 from ductape.common.utils import slice_it
-from ductape.genome.blast import Blaster, RunBBH
+from ductape.genome.blast import Blaster, RunAllBlast, RunSliceBlast, RunTagged
+from ductape.genome.blast import getFastaIndex, stripLocalID
 import Queue
+import hashlib
 import logging
 import os
 import webbrowser
@@ -22,6 +25,12 @@ __author__ = "Marco Galardini"
 
 logger = logging.getLogger('ductape.map2KO')
 
+################################################################################
+# Constants
+
+# Minimum number of query sequences in each Blast slice
+minslice = 50
+
 ################################################################################
 # Classes
 
@@ -45,13 +54,16 @@ class LocalSearch(CommonMultiProcess):
     
     def __init__(self,query,target,
                  ncpus=1,evalue=1e-50,
-                 buildDB=True,bbh=True,recover=False,queue=Queue.Queue()):
+                 buildDB=True,bbh=True,recover=False,scratch=None,
+                 db=None,room='blast',backend='blast',
+                 queue=Queue.Queue()):
         CommonMultiProcess.__init__(self,ncpus,queue)
         # Blast
         self.query = query
         if buildDB:
             self.target = target
-            self.db = None
+            # KEGG Blast DB already built from target (if any)
+            self.db = db
         else:
             self.target = None
             self.db = target
@@ -60,26 +72,61 @@ class LocalSearch(CommonMultiProcess):
         self.bbh = bool(bbh)
         self.recover = recover
         self.ncpus = int(ncpus)
-        self._kohits = []
+        # Query --> best KO hit
+        self._best = {}
+        self._parsed = set()
         self.results = {}
+        # Shared workers pool: pending tasks and forward slices
+        self._threads = 1
+        self._pending = 0
+        self._forward = 0
+        self._manifest = None
+        # Reverse searches: (short, KEGG entry) --> best source protein
+        self._sourcedb = None
+        self._reventries = []
+        self._revindex = {}
+        self._reverse = {}
+        self._reversed = 0
+        self._batches = 0
         self._keggroom = None
-        self._blast = Blaster()
+        # Scratch files location (i.e. a tmpfs)
+        self.scratch = scratch
+        # tmp directory name
+        self.roomname = room
+        # Search backend name
+        self.backend = backend
+        self._blast = Blaster(backend, scratch)
         
     def makeRoom(self,location=''):
         '''
         Creates a tmp directory in the desired location
         '''
-        try:
-            path = os.path.abspath(location)
-            path = os.path.join(path, 'tmp')
-            try:os.mkdir(path)
-            except:pass
-            path = os.path.join(path, 'blast')
-            self._room = path
-            os.mkdir(path)
-        except:
-            logger.debug('Temporary directory creation failed! %s'
-                          %path)
+        if self.scratch:
+            # Same location and room, same directory: a recovered run
+            # finds the slices of the interrupted one
+            key = hashlib.sha1('%s\t%s'%(os.path.abspath(location),
+                                          self.roomname)).hexdigest()[:12]
+            path = os.path.join(os.path.abspath(self.scratch),
+                                'blast_%s'%key)
+            try:
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                self._room = path
+            except:
+                logger.warning('Could not use the scratch location %s'%
+                               self.scratch)
+        if not self._room:
+            try:
+                path = os.path.abspath(location)
+                path = os.path.join(path, 'tmp')
+                try:os.mkdir(path)
+                except:pass
+                path = os.path.join(path, self.roomname)
+                self._room = path
+                os.mkdir(path)
+            except:
+                logger.debug('Temporary directory creation failed! %s'
+                              %path)
         
         # KEGG database path
         try:
@@ -95,8 +142,240 @@ class LocalSearch(CommonMultiProcess):
                           %path)
         
     def createDB(self):
-        self.db = os.path.join(self._keggroom,'KEGGdb') 
-        return self._blast.createDB(self.target, 'prot', self.db)
+        # Taken from the DBs cache, if possible
+        self.db = self._blast.createCachedDB(self.target, 'prot',
+                                        os.path.join(self._keggroom,'KEGGdb'))
+        return bool(self.db)
+    
+    def _scheduleSlices(self, nseqs):
+        '''
+        Returns the number of query slices and the Blast threads to be
+        used for each of them
+        blastp scales poorly with threads on small queries, so the
+        CPUs are used to run more slices at once; threads are used
+        only when there are too few sequences to be sliced
+        '''
+        if nseqs == 0:
+            return 0, self.ncpus
+        nslices = min(max(10, self.ncpus * 4),
+                      max(1, nseqs / minslice))
+        threads = max(1, self.ncpus / min(self.ncpus, nslices))
+        return nslices, threads
+    
+    def _readManifest(self, manifest):
+        '''
+        Returns the number of slices and the completed slices
+        (out --> (sequences, output size)) listed in a manifest
+        '''
+        nslices = None
+        done = {}
+        if not os.path.exists(manifest):
+            return nslices, done
+        
+        for l in open(manifest):
+            # Partial lines are discarded
+            if not l.endswith('\n'):
+                continue
+            s = l.rstrip('\n').split('\t')
+            if s[0] == '#' and len(s) == 2:
+                nslices = int(s[1])
+            elif len(s) == 3:
+                done[s[0]] = (int(s[1]), int(s[2]))
+        return nslices, done
+    
+    def _startPool(self, threads):
+        '''
+        Starts the workers pool, shared by the forward and reverse searches
+        '''
+        if self._parallel is not None:
+            return
+        self._threads = threads
+        self.initiateParallel(max(1, self.ncpus / threads))
+    
+    def _stopPool(self):
+        '''
+        Stops the workers pool, after the pending tasks have been done
+        '''
+        if self._parallel is None:
+            return
+        self.addPoison()
+        while not self.isTerminated():
+            self.sleeper.sleep(0.1)
+        self.killParallel()
+        self._parallel = None
+    
+    def _abortPool(self):
+        if self._parallel is None:
+            return
+        self.killParallel()
+        self._parallel = None
+    
+    def _submit(self, tag, task):
+        self._paralleltasks.put(RunTagged(tag, task))
+        self._pending += 1
+    
+    def _waitResults(self, forward=False):
+        '''
+        Handles the results coming from the pool, until the forward
+        searches (or all the searches) are done
+        Returns False if something went wrong or for a kill signal
+        '''
+        while ((forward and self._forward > 0) or
+               (not forward and self._pending > 0)):
+            if self._parallelresults.empty():
+                if self.killed:
+                    logger.debug('Exiting for a kill signal')
+                    self._abortPool()
+                    return False
+                self.sleeper.sleep(0.1)
+                continue
+            
+            tag, result = self._parallelresults.get()
+            self._pending -= 1
+            
+            if tag[0] == 'forward':
+                self._forward -= 1
+                query, out, res = result
+                if not res:
+                    logger.error('Blast failed for slice %s'%query)
+                    self._abortPool()
+                    return False
+                
+                # Completed slice
+                self._manifest.write('%s\t%d\t%d\n'%(out, tag[1],
+                                                     os.path.getsize(out)))
+                self._manifest.flush()
+                
+                self._substatus += tag[1]
+                self.updateStatus(sub=True)
+                
+                if not self._parseSlice(out):
+                    self._abortPool()
+                    return False
+            else:
+                out, res = result[2:]
+                if not res:
+                    logger.error('Reverse Blast failed for %s'%out)
+                    self._abortPool()
+                    return False
+                
+                for hits in self._blast.getTabularHits(out, self.evalue):
+                    if len(hits) == 0:
+                        continue
+                    index = self._getReverseIndex(hits[0].query_id)
+                    if index is None:
+                        logger.error('Unexpected reverse query %s in %s'%
+                                     (hits[0].query_id, out))
+                        self._abortPool()
+                        return False
+                    entry = self._reventries[index]
+                    self._reverse[entry] = stripLocalID(hits[0].hit)
+                
+                self._reversed += tag[1]
+                if not forward:
+                    self._substatus = self._reversed
+                    self.updateStatus(sub=True)
+        
+        return True
+    
+    def _getReverseIndex(self, query_id):
+        '''
+        Get the reverse entry index from a query ID ("q<index>"),
+        even if Blast+ has decorated it (i.e. "lcl|" or "gi|")
+        Returns None if the ID can't be parsed
+        '''
+        query = stripLocalID(query_id).strip('|').split('|')[-1]
+        if not query.startswith('q'):
+            return None
+        try:
+            index = int(query[1:])
+        except ValueError:
+            return None
+        if index < 0 or index >= len(self._reventries):
+            return None
+        return index
+    
+    def _parseSlice(self, out):
+        '''
+        Keeps the best KO hit of each query of a Blast slice and,
+        if BBH is requested, starts the reverse search of the
+        new KEGG entries
+        '''
+        # Catch the exceptions if the output is dirty
+        try:
+            updated = []
+            for hits in self._blast.getTabularHits(out, self.evalue):
+                for hit in hits:
+                    if hit.getKO():
+                        break
+                else:
+                    continue
+                
+                query = stripLocalID(hit.query_id)
+                old = self._best.get(query)
+                if old is None or hit.bits > old.bits:
+                    self._best[query] = hit
+                    updated.append(hit)
+        except:
+            logger.error('Blast results corrupted for file %s'%out)
+            return False
+        self._parsed.add(out)
+        
+        if self.bbh:
+            return self._reverseSearch(updated)
+        return True
+    
+    def _reverseSearch(self, hits):
+        '''
+        Blast the KEGG entries of the hits back against the source
+        proteome; the entries hit by short proteins are searched back
+        with blastp-short
+        '''
+        entries = []
+        for hit in hits:
+            entry = (hit.query_len <= 30, hit.hit)
+            if entry in self._revindex or entry in entries:
+                continue
+            entries.append(entry)
+        
+        # All the KEGG sequences retrieved at once
+        seqs = self._blast.fetchSequences(self.db,
+                                          list(set([x[1] for x in entries])),
+                                          fasta=self.target)
+        
+        batch = {False:[], True:[]}
+        for entry in entries:
+            seq = seqs.get(entry[1])
+            if seq is None:
+                logger.error('Could not retrieve the KEGG sequence %s'%entry[1])
+                return False
+            
+            # Non-numeric plain IDs, so that Blast won't read them as GIs
+            self._revindex[entry] = len(self._reventries)
+            batch[entry[0]].append('>q%d\n%s\n'%(len(self._reventries),
+                                           seq.split('\n', 1)[1].strip()))
+            self._reventries.append(entry)
+        
+        for short in (False, True):
+            if len(batch[short]) == 0:
+                continue
+            if short:
+                prefix = 'KEGGreturnshort'
+            else:
+                prefix = 'KEGGreturn'
+            self._batches += 1
+            query = os.path.join(self._room, '%s_%d.faa'%(prefix,
+                                                          self._batches))
+            out = os.path.join(self._room, '%s_%d.tab'%(prefix,
+                                                        self._batches))
+            fquery = open(query, 'w')
+            fquery.write(''.join(batch[short]))
+            fquery.close()
+            self._submit(('reverse', len(batch[short])),
+                         RunAllBlast(query, self._sourcedb, 'KEGG', None, out,
+                                     self.evalue, 'BLOSUM62', short,
+                                     self._threads, self.backend))
+        return True
     
     def runBlast(self,short=False):
         lS = []
@@ -105,149 +384,118 @@ class LocalSearch(CommonMultiProcess):
                 lS.append(s)
             elif not short:lS.append(s)
         self._maxsubstatus = len(lS)
-        for seqs in slice_it(lS,10):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
+        
+        if self.bbh and not self._sourcedb:
+            # Create a DB of the source genome, for the reverse searches
+            self._sourcedb = self._blast.createCachedDB(self.query, 'prot',
+                                        os.path.join(self._room,'SOURCEdb'))
+            if not self._sourcedb:
+                logger.error('Could not create source DB for %s'%self.query)
                 return False
-            
+        
+        if short:
+            prefix = 'KEGGshort'
+        else:
+            prefix = 'KEGG'
+        manifest = os.path.join(self._room, '%s.manifest'%prefix)
+        
+        nslices, threads = self._scheduleSlices(len(lS))
+        
+        # If recovery, the slicing of the previous run is kept
+        # and the completed slices are skipped
+        done = {}
+        if self.recover:
+            oldslices, done = self._readManifest(manifest)
+            if oldslices is not None and len(lS) > 0:
+                nslices = oldslices
+            else:
+                done = {}
+        
+        # The manifest is rewritten, without any partial line
+        self._manifest = open(manifest, 'w')
+        self._manifest.write('#\t%d\n'%nslices)
+        self._manifest.flush()
+        
+        if len(lS) == 0:
+            self._manifest.close()
+            return True
+        
+        self._startPool(threads)
+        
+        for i, seqs in enumerate(slice_it(lS, nslices)):
             if len(seqs) == 0:
                 continue
-            self._substatus += len(seqs)
-            self.updateStatus(sub=True)
-            if short:
-                query = os.path.join(self._room,
-                         'KEGGshort_%d.faa'%self._substatus)
-                out = os.path.join(self._room,
-                           'KEGGshort_%d.xml'%self._substatus)
-            else:
-                query = os.path.join(self._room,
-                         'KEGG_%d.faa'%self._substatus)
-                out = os.path.join(self._room,'KEGG_%d.xml'%self._substatus)
+            query = os.path.join(self._room, '%s_%d.faa'%(prefix, i))
+            out = os.path.join(self._room, '%s_%d.tab'%(prefix, i))
             self.out.append(out)
-            # If recovery, skip the unnecessary scans
-            if ( self.recover and os.path.exists(query) and
-                 os.path.exists(out)):
-                # Last test: can it be parsed?
-                try:
-                    self._blast.parseBlast(out)
-                    for hits in self._blast.getHits(self.evalue):
-                        pass
-                    logger.debug('Skipping slice %s because has already been done'
-                                %query)
-                    continue
-                except:
-                    pass
+            
+            if ( out in done and done[out][0] == len(seqs) and
+                 os.path.exists(out) and
+                 os.path.getsize(out) == done[out][1] ):
+                logger.debug('Skipping slice %s because has already been done'
+                            %query)
+                self._manifest.write('%s\t%d\t%d\n'%(out, done[out][0],
+                                                     done[out][1]))
+                self._manifest.flush()
+                self._substatus += len(seqs)
+                self.updateStatus(sub=True)
+                if not self._parseSlice(out):
+                    self._abortPool()
+                    self._manifest.close()
+                    return False
+                continue
+            
             oseqs = SeqIO.write(seqs,open(query,'w'),'fasta')
             if oseqs != len(seqs):
                 logger.warning('Query splitting error! Expected %d, '+
                                 'Printed %d'%(len(seqs),oseqs))
-            if short:
-                res = self._blast.runBlast(query, self.db, out,
-                                 evalue = self.evalue,
-                                 ncpus = self.ncpus, task='blastp-short')
-            else:
-                res = self._blast.runBlast(query, self.db, out,
-                                 evalue = self.evalue,
-                                 ncpus = self.ncpus)
-            if not res:
-                return False
-        return True
+            self._forward += 1
+            self._submit(('forward', len(seqs)),
+                         RunSliceBlast(query, self.db, out, self.evalue,
+                                       short, self._threads,
+                                       backend=self.backend))
+        
+        logger.debug('Running %d Blast slices (%d threads each)'%
+                     (self._forward, self._threads))
+        
+        # Slices are parsed (and reverse searches started)
+        # as soon as they are done
+        res = self._waitResults(forward=True)
+        self._manifest.close()
+        
+        return res
     
     def parseBlast(self):
+        # Slices are parsed as soon as they are done, only the
+        # leftovers are parsed here
         for out in self.out:
             if self.killed:
                 logger.debug('Exiting for a kill signal')
                 return False
-        
-            self._blast.parseBlast(out)
-            # Catch the exceptions if the XML is dirty
-            try:
-                for hits in self._blast.getHits(self.evalue):
-                    for hit in hits:
-                        if hit.getKO():
-                            self._kohits.append(hit)
-            except:
-                logger.error('Blast results corrupted for file %s'%out)
+            
+            if out in self._parsed:
+                continue
+            if not self._parseSlice(out):
                 return False
         return True
     
     def runBBH(self):
-        # Create a DB of the source genome
-        sourceDB = os.path.join(self._room,'SOURCEdb') 
-        if not self._blast.createDB(self.query, 'prot', sourceDB):
-            logger.error('Could not create source DB %s'%sourceDB)
-            return False
-        self._maxsubstatus = len(self._kohits)
+        self._maxsubstatus = len(self._reventries)
+        self._substatus = self._reversed
+        self.updateStatus(sub=True)
         
-        self.initiateParallel()
+        # Wait for the pending reverse searches
+        if not self._waitResults():
+            logger.error('An error occurred for BBH!')
+            return False
+        self._stopPool()
         
-        for hit in self._kohits:
-            uniqueid = self.getUniqueID()
-            
-            if hit.query_len > 30:
-                short = False
-            else:
-                short = True
-            
-            # Multi process
-            obj = RunBBH('Map2KO',hit.query_id,sourceDB,
-                    self.db,None,
-                    self.evalue,'BLOSUM62',short,uniqueid,
-                    kegg = True, ko_entry = hit.hit, ko_id = hit.getKO())
-            self._paralleltasks.put(obj)
-            
-        # Poison pill to stop the workers
-        self.addPoison()
+        # BBH resolution
+        for query, hit in self._best.iteritems():
+            entry = (hit.query_len <= 30, hit.hit)
+            if self._reverse.get(entry) == stripLocalID(query):
+                self.results[query] = [hit.getKO()]
         
-        while True:
-            while not self._parallelresults.empty():
-                if self.killed:
-                    logger.debug('Exiting for a kill signal')
-                    return False
-                
-                self._substatus += 1
-                self.updateStatus(sub=True)
-                
-                result = self._parallelresults.get()
-                
-                if not result[2]:
-                    logger.error('An error occurred for BBH!')
-                    return False
-                if result[1] not in self.results and result[0]:
-                    self.results[result[1]] = []
-                if result[0] and result[0] not in self.results[result[1]]:
-                    self.results[result[1]].append(result[0])
-                    
-            if self.isTerminated():
-                break
-            
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return False
-            
-            self.sleeper.sleep(0.1)
-            
-        # Get the last messages
-        while not self._parallelresults.empty():
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return False
-            
-            self._substatus += 1
-            self.updateStatus(sub=True)
-            
-            result = self._parallelresults.get()
-            
-            if not result[2]:
-                logger.error('An error occurred for BBH!')
-                return False
-            if result[1] not in self.results and result[0]:
-                self.results[result[1]] = []
-            if result[0] and result[0] not in self.results[result[1]]:
-                self.results[result[1]].append(result[0])
-            
-        self.killParallel()            
-
         return True
             
     def run(self):
@@ -270,33 +518,40 @@ class LocalSearch(CommonMultiProcess):
 
         self.updateStatus()
         if not self.runBlast():
+            self._abortPool()
             self.sendFailure('RunBlast failure')
             return
         self.resetSubStatus()
         
         if self.killed:
+            self._abortPool()
             return
         
         self.updateStatus()
         if not self.runBlast(True):
+            self._abortPool()
             self.sendFailure('RunBlast (short) failure')
             return
         self.resetSubStatus()
         
         if self.killed:
+            self._abortPool()
             return
         
         self.updateStatus()
         if not self.parseBlast():
+            self._abortPool()
             self.sendFailure('ParseBlast failure')
             return
-        if len(self._kohits) == 0:
+        if len(self._best) == 0:
+            self._abortPool()
             logger.warning('No protein in %s with homology to KO!'%self.query)
             self.sendFailure('No protein in %s with homology to KO!'%self.query)
             self.cleanUp()
             return
         
         if self.killed:
+            self._abortPool()
             return
         
         if self.bbh:
@@ -304,12 +559,9 @@ class LocalSearch(CommonMultiProcess):
             if not self.runBBH():
                 self.sendFailure('BBH failure')
         else:
-            for hit in self._kohits:
-                if hit.query_id not in self.results:
-                    self.results[hit.query_id] = []
-                ko = hit.getKO()
-                if ko not in self.results[hit.query_id]:
-                    self.results[hit.query_id].append(ko)
+            self._stopPool()
+            for query, hit in self._best.iteritems():
+                self.results[query] = [hit.getKO()]
             self.updateStatus(send=False)   
         self.resetSubStatus()
         
@@ -335,6 +587,178 @@ class LocalSearch(CommonMultiProcess):
         self.updateStatus()
         self.cleanUp()
 
+class MultiLocalSearch(CommonThread):
+    '''
+    Class MultiLocalSearch
+    Local KO mapping of many proteomes at once: the KEGG Blast DB
+    is built once and the proteomes are mapped concurrently,
+    sharing a global CPU budget
+    Results of each proteome are put in the finished queue
+    (org_id, results) as soon as it is done
+    '''
+    _statusDesc = {0:'Not started',
+               1:'Making room', 
+               2:'Creating Blast DB',
+               3:'Mapping proteomes to KO'}
+    
+    _substatuses = [3]
+    
+    def __init__(self,queries,target,
+                 ncpus=1,evalue=1e-50,
+                 buildDB=True,bbh=True,recover=False,scratch=None,
+                 backend='blast',queue=Queue.Queue()):
+        CommonThread.__init__(self,queue)
+        # org_id --> proteome
+        self.queries = queries
+        if buildDB:
+            self.target = target
+            self.db = None
+        else:
+            self.target = None
+            self.db = target
+        self.evalue = float(evalue)
+        self.bbh = bool(bbh)
+        self.recover = recover
+        self.ncpus = int(ncpus)
+        self.scratch = scratch
+        # org_id --> results
+        self.results = {}
+        self.finished = Queue.Queue()
+        self._keggroom = None
+        # Search backend name
+        self.backend = backend
+        self._blast = Blaster(backend)
+        self.sleeper = SafeSleep()
+        
+    def makeRoom(self,location=''):
+        '''
+        Creates the KEGG DB directory in the desired location
+        '''
+        try:
+            path = os.path.abspath(location)
+            path = os.path.join(path, 'tmp')
+            try:os.mkdir(path)
+            except:pass
+            path = os.path.join(path, 'keggdb')
+            self._keggroom = path
+            os.mkdir(path)
+        except:
+            logger.debug('Temporary directory creation failed! %s'
+                          %path)
+    
+    def createDB(self):
+        # Taken from the DBs cache, if possible
+        self.db = self._blast.createCachedDB(self.target, 'prot',
+                                        os.path.join(self._keggroom,'KEGGdb'))
+        return bool(self.db)
+    
+    def _newSearch(self, org_id, ncpus):
+        if self.target is not None:
+            target = self.target
+        else:
+            target = self.db
+        # Each proteome has its own tmp directory
+        return LocalSearch(self.queries[org_id], target,
+                           ncpus=ncpus, evalue=self.evalue,
+                           buildDB=self.target is not None, bbh=self.bbh,
+                           recover=self.recover, scratch=self.scratch,
+                           db=self.db, room='blast_%s'%org_id,
+                           backend=self.backend,
+                           queue=Queue.Queue())
+    
+    def mapAll(self):
+        '''
+        Runs the proteomes searches, so that no more than ncpus
+        CPUs are used at once
+        '''
+        waiting = sorted(self.queries)
+        # org_id --> (search, cpus)
+        running = {}
+        slots = min(self.ncpus, len(waiting))
+        free = self.ncpus
+        
+        self._maxsubstatus = len(waiting)
+        
+        while len(waiting) > 0 or len(running) > 0:
+            # Start new searches, the free CPUs are shared
+            while len(waiting) > 0 and len(running) < slots:
+                org_id = waiting.pop(0)
+                cpus = max(1, free / (slots - len(running)))
+                free -= cpus
+                search = self._newSearch(org_id, cpus)
+                running[org_id] = (search, cpus)
+                logger.debug('Mapping %s to KO (%d CPUs)'%(org_id, cpus))
+                search.start()
+            
+            for org_id in sorted(running):
+                search, cpus = running[org_id]
+                
+                failure = None
+                while not search.msg.empty():
+                    msg = search.msg.get()
+                    if msg and msg.fail:
+                        failure = msg.msg
+                
+                if failure is None and search.isAlive():
+                    continue
+                
+                search.join()
+                del running[org_id]
+                free += cpus
+                
+                if failure is not None or search.killed:
+                    for other, ocpus in running.itervalues():
+                        other.kill()
+                    for other, ocpus in running.itervalues():
+                        other.join()
+                    if failure is not None:
+                        logger.error('%s - %s'%(org_id, failure))
+                    return False
+                
+                self.results[org_id] = search.results
+                self.finished.put((org_id, search.results))
+                
+                self._substatus += 1
+                self.updateStatus(sub=True)
+            
+            if self.killed:
+                logger.debug('Exiting for a kill signal')
+                for search, cpus in running.itervalues():
+                    search.kill()
+                for search, cpus in running.itervalues():
+                    search.join()
+                return False
+            
+            self.sleeper.sleep(0.1)
+        
+        return True
+    
+    def run(self):
+        self.updateStatus()
+        self.makeRoom()
+        
+        if self.killed:
+            return
+        
+        if not self.db:
+            self.updateStatus()
+            if not self.createDB():
+                self.sendFailure('CreateDB failure')
+                return
+            # KEGG sequences index, shared by the searches
+            getFastaIndex(self.target)
+        else:
+            self.updateStatus(send=False)
+        
+        if self.killed:
+            return
+        
+        self.updateStatus()
+        if not self.mapAll():
+            self.sendFailure('Map2KO failure')
+            return
+        self.resetSubStatus()
+
 class OnlineSearch(object):
     '''
     Online KO search using KAAS
@@ -5,12 +5,21 @@ PanGenome
 Genome library
 
 Uses a serial-BBH approach to compute a pangenome of the desired organisms list
+A batched approach (one all-vs-all Blast run for each organisms pair) can also
+be used, with the ortholog groups derived either greedily or as connected
+components of the BBH graph
 """
 from Bio import SeqIO
 from ductape.common.commonmultiprocess import CommonMultiProcess
-from ductape.genome.blast import Blaster, RunBBH
+from ductape.genome.blast import Blaster, RunBBH, RunAllBlast, RunTagged
+from ductape.genome.blast import getFastaIndex, stripLocalID
+from ductape.genome.prefilter import KmerIndex
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import Queue
+import hashlib
 import logging
+import numpy as np
 import os
 import shutil
 
@@ -24,6 +33,68 @@ logger = logging.getLogger('ductape.pangenome')
 ################################################################################
 # Classes
 
+class OrthologGroups(object):
+    '''
+    Ortholog groups bookkeeping
+    Keeps the protein --> group and group --> organisms maps, so that
+    membership tests are done in constant time
+    '''
+    def __init__(self):
+        # Group --> proteins list (in insertion order)
+        self.groups = {}
+        self._prot2group = {}
+        self._group2orgs = {}
+    
+    def __len__(self):
+        return len(self.groups)
+    
+    def __iter__(self):
+        return iter(self.groups)
+    
+    def __contains__(self, protein):
+        '''
+        True if the protein has already been assigned to a group
+        '''
+        return protein in self._prot2group
+    
+    def newGroup(self, group, protein, org):
+        '''
+        Create a new group, seeded with a protein
+        Returns False if the group or the protein are already present
+        '''
+        if group in self.groups or protein in self._prot2group:
+            return False
+        self.groups[group] = []
+        self._group2orgs[group] = set()
+        return self.addProtein(group, protein, org)
+    
+    def addProtein(self, group, protein, org):
+        '''
+        Add a protein to a group
+        Returns False if the protein was already assigned
+        '''
+        if protein in self._prot2group:
+            return False
+        self.groups[group].append(protein)
+        self._prot2group[protein] = group
+        self._group2orgs[group].add(org)
+        return True
+    
+    def getGroup(self, protein):
+        '''
+        Get the group of a protein (None if not assigned)
+        '''
+        return self._prot2group.get(protein)
+    
+    def getProteins(self, group):
+        return self.groups[group]
+    
+    def getOrganisms(self, group):
+        return self._group2orgs[group]
+    
+    def hasOrganism(self, group, org):
+        return org in self._group2orgs[group]
+
 class PanGenomer(CommonMultiProcess):
     '''
     Class panGenomer
@@ -40,25 +111,67 @@ class PanGenomer(CommonMultiProcess):
     def __init__(self,organisms,
                  ncpus=1,evalue=1e-10,
                  recover=False,prefix='',
-                 matrix='BLOSUM80',queue=Queue.Queue()):
+                 matrix='BLOSUM80',batch=False,graph=False,pangenome=None,
+                 prefilter=False,scratch=None,backend='blast',
+                 prefiltercheck=False,queue=Queue.Queue()):
         CommonMultiProcess.__init__(self,ncpus,queue)
         # Blast
         self.organisms = list(organisms)
+        # Existing pangenome (group --> proteins) to be updated
+        self.pangenome = pangenome
+        # Organisms not present in the existing pangenome
+        self._neworgs = list(self.organisms)
         self.dbs = {}
         self._prot2orgs = {}
+        # Proteins IDs, in file order
+        self._orgprots = {}
+        # Fasta indexes
+        self._index = {}
+        # All-vs-all Blast instead of one query per protein
+        self.batch = bool(batch)
+        # Groups as connected components of the BBH graph
+        # (implies all-vs-all Blast)
+        self.graph = bool(graph)
+        # BBH edges (proteins indexes)
+        self.edges = None
+        # k-mer prefilter (serial BBH only)
+        self.prefilter = bool(prefilter) or bool(prefiltercheck)
+        self._kmers = {}
+        # Recall check: for each organisms pair, the first filtered pair
+        # and then one every checkevery are searched anyway
+        # (all of them if prefiltercheck is set)
+        self.checkevery = 100
+        if prefiltercheck:
+            self.checkevery = 1
+        self.prefilterStats = {'pairs':0, 'avoided':0,
+                               'checked':0, 'missed':0}
+        self._filtered = {}
+        self._checked = set()
         self.out = []
         self.evalue = float(evalue)
-        # TODO: implement recovery
-        self.recover = recover
-        #
+        # Resume from the last checkpoint
+        self.recover = bool(recover)
+        self._checkpoint = None
         self.results = {}
-        self._blast = Blaster()
+        # Search backend name
+        self.backend = backend
+        self._blast = Blaster(backend)
         self._pangenomeroom = None
+        # Scratch files location (i.e. a tmpfs)
+        self.scratch = scratch
+        self._inscratch = False
+        # Whether the scratch files are needed by a resumed run
+        self._resumable = False
         self.prefix = prefix.rstrip('_')
         self.matrix = matrix
-        self._already = []
+        # Ortholog groups (and proteins already assigned)
+        self.groups = OrthologGroups()
+        # Shared pool bookkeeping
+        self._pending = {}
+        self._results = {}
+        self._dropped = set()
         # Results
-        self.orthologs = {}
+        self.orthologs = self.groups.groups
         self.core = []
         self.accessory = []
         self.unique = []
@@ -79,6 +192,27 @@ class PanGenomer(CommonMultiProcess):
             logger.debug('Temporary directory creation failed! %s'
                           %path)
         
+        # The checkpoint is kept with the DBs, out of the scratch location
+        self._checkpoint = os.path.join(self._room, 'checkpoint.tsv')
+        
+        if self.scratch:
+            # Same project and prefix, same directory: a resumed run
+            # finds the Blast outputs of the interrupted one
+            key = hashlib.sha1('%s\t%s'%(os.path.abspath(self._room),
+                                          self.prefix)).hexdigest()[:12]
+            path = os.path.join(os.path.abspath(self.scratch),
+                                'pangenome_%s'%key)
+            try:
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                self._pangenomeroom = path
+                self._inscratch = True
+                return
+            except:
+                logger.warning('Could not use the scratch location %s'%
+                               self.scratch)
+        self._inscratch = False
+        
         try:
             path = os.path.abspath(location)
             path = os.path.join(path, 'tmp')
@@ -107,213 +241,732 @@ class PanGenomer(CommonMultiProcess):
             self._substatus += 1
             self.updateStatus(sub=True)
             
-            seqs = [seq.id for seq in SeqIO.parse(open(org),'fasta')]
+            # The index is built before the worker pool is started
+            # so that it can be shared
+            self._index[org] = getFastaIndex(org)
+            seqs = self._index[org].ids
+            self._orgprots[org] = seqs
             for seqid in seqs:
                 if seqid in self._prot2orgs:
                     logger.warning('Protein %s present as duplicate!'%seqid)
                     return False
                 self._prot2orgs[seqid] = org            
-            self.dbs[org] = os.path.join(self._room,str(dbindex)) 
-            res = self._blast.createDB(org, 'prot', self.dbs[org])
-            if not res:
+            db = os.path.join(self._room,str(dbindex)) 
+            # Taken from the DBs cache, if possible
+            self.dbs[org] = self._blast.createCachedDB(org, 'prot', db)
+            if not self.dbs[org]:
                 logger.error('Could not create DB for %s'%org)
                 return False
+            if self.prefilter and not self.batch and not self.graph:
+                self._kmers[org] = KmerIndex(org)
             dbindex += 1
         return True
     
+    def loadPanGenome(self):
+        '''
+        Load the existing pangenome, to be updated with the new organisms
+        Returns False if some proteins are unknown
+        '''
+        if not self.pangenome:
+            return True
+        
+        for group in sorted(self.pangenome):
+            prots = self.pangenome[group]
+            for prot in prots:
+                if prot not in self._prot2orgs:
+                    logger.error('Unknown protein %s in the pangenome'%prot)
+                    return False
+            self.groups.newGroup(group, prots[0], self._prot2orgs[prots[0]])
+            for prot in prots[1:]:
+                self.groups.addProtein(group, prot, self._prot2orgs[prot])
+        
+        self._neworgs = [org for org in self.organisms
+                         if not [x for x in self._orgprots[org]
+                                 if x in self.groups]]
+        logger.debug('Updating the pangenome with %d organisms'%
+                     len(self._neworgs))
+        
+        return True
+    
+    def _checkpointHeader(self):
+        if self.pangenome:
+            mode = 'update'
+        else:
+            mode = 'full'
+        return '\t'.join(['#', self.prefix, mode] + self.organisms)
+    
+    def loadCheckpoint(self):
+        '''
+        Load the ortholog groups saved by a previous (interrupted) run
+        Groups already present (update mode) are extended
+        Returns the set of groups loaded
+        '''
+        if not os.path.exists(self._checkpoint):
+            return set()
+        
+        f = open(self._checkpoint)
+        if f.readline().rstrip('\n') != self._checkpointHeader():
+            logger.warning('Checkpoint %s refers to a different '%
+                           self._checkpoint+'analysis: starting from scratch')
+            f.close()
+            os.remove(self._checkpoint)
+            return set()
+        
+        lines = []
+        truncated = False
+        for l in f:
+            # Last line may be truncated
+            if not l.endswith('\n'):
+                truncated = True
+                break
+            s = l.rstrip('\n').split('\t')
+            for prot in s[1:]:
+                if prot not in self._prot2orgs:
+                    logger.warning('Unknown protein %s in checkpoint: '%prot+
+                                   'starting from scratch')
+                    f.close()
+                    os.remove(self._checkpoint)
+                    return set()
+            lines.append(l)
+        f.close()
+        
+        if truncated:
+            f = open(self._checkpoint, 'w')
+            f.write(self._checkpointHeader() + '\n')
+            f.write(''.join(lines))
+            f.close()
+        
+        loaded = set()
+        for l in lines:
+            s = l.rstrip('\n').split('\t')
+            if s[0] not in self.orthologs:
+                self.groups.newGroup(s[0], s[1], self._prot2orgs[s[1]])
+            for prot in s[1:]:
+                self.groups.addProtein(s[0], prot, self._prot2orgs[prot])
+            loaded.add(s[0])
+        
+        return loaded
+    
+    def _saveGroup(self, handle, group):
+        '''
+        Append a completed ortholog group to the checkpoint
+        '''
+        handle.write('\t'.join([group] + self.groups.getProteins(group)) +
+                     '\n')
+        handle.flush()
+    
+    def _putBBH(self, tag, seq, source, targets):
+        '''
+        Queue the BBH tasks of a protein against the target organisms
+        Results are collected by _getResults under the provided tag
+        '''
+        self._pending[tag] = 0
+        self._results[tag] = {}
+        if len(targets) == 0:
+            return True
+        
+        # The query is sent to Blast through stdin
+        queryseq = seq.format('fasta')
+        
+        if len(seq) < 30:
+            short = True
+        else:
+            short = False
+        
+        for otherorg in targets:
+            # Short queries are always searched
+            if otherorg in self._kmers and not short:
+                self.prefilterStats['pairs'] += 1
+                if not self._kmers[otherorg].hasCandidates(seq.seq):
+                    pair = (source, otherorg)
+                    filtered = self._filtered.get(pair, 0)
+                    self._filtered[pair] = filtered + 1
+                    if filtered % self.checkevery != 0:
+                        self.prefilterStats['avoided'] += 1
+                        self._results[tag][otherorg] = None
+                        continue
+                    # Recall check: run Blast anyway
+                    self.prefilterStats['checked'] += 1
+                    self._checked.add((tag, otherorg))
+            
+            uniqueid = self.getUniqueID()
+            
+            # Multi process
+            obj = RunTagged(tag, RunBBH(None,seq.id,self.dbs[source],
+                            self.dbs[otherorg],otherorg,
+                            self.evalue,self.matrix,short=short,
+                            uniqueid=uniqueid,targetfasta=otherorg,
+                            queryseq=queryseq,backend=self.backend,
+                            scratch=self._pangenomeroom))
+            self._paralleltasks.put(obj)
+            self._pending[tag] += 1
+        
+        return True
+    
+    def _getResults(self):
+        '''
+        Collect the BBH results already available
+        Returns False if a BBH has failed
+        '''
+        while not self._parallelresults.empty():
+            tag, result = self._parallelresults.get()
+            
+            self._pending[tag] -= 1
+            
+            if tag in self._dropped:
+                # Protein already part of an ortholog group
+                if self._pending[tag] == 0:
+                    del self._pending[tag]
+                    self._dropped.remove(tag)
+                continue
+            
+            if not result[2]:
+                logger.error('An error occurred for BBH on query %s'%tag[1]+
+                             ' and target %s'%result[1])
+                return False
+            
+            self._results[tag][result[1]] = result[0]
+            
+            if (tag, result[1]) in self._checked:
+                self._checked.remove((tag, result[1]))
+                if result[0]:
+                    self.prefilterStats['missed'] += 1
+        
+        return True
+    
+    def _waitBBH(self, tag):
+        '''
+        Wait for all the BBH results of a tag
+        Returns a dictionary organism --> hit (or None)
+        '''
+        while self._pending[tag] > 0:
+            if self.killed:
+                logger.debug('Exiting for a kill signal')
+                return
+            
+            if not self._getResults():
+                return
+            
+            if self._pending[tag] > 0:
+                self.sleeper.sleep(0.01)
+        
+        del self._pending[tag]
+        return self._results.pop(tag)
+    
+    def _dropBBH(self, tag):
+        '''
+        Forget the tasks of a tag: late results will be discarded
+        '''
+        if tag not in self._pending:
+            return
+        del self._results[tag]
+        if self._pending[tag] == 0:
+            del self._pending[tag]
+        else:
+            self._dropped.add(tag)
+    
+    def _newGroup(self, protein, org):
+        '''
+        Create a new ortholog group, with the first free name
+        '''
+        while self.prefix + str(self._orthindex) in self.orthologs:
+            self._orthindex += 1
+        orthname = self.prefix + str(self._orthindex)
+        self.groups.newGroup(orthname, protein, org)
+        return orthname
+    
+    def _missingOrganisms(self, orthname):
+        return [x for x in self._neworgs
+                if not self.groups.hasOrganism(orthname, x)]
+    
+    def _additionalSearch(self, orthname, seqid, org):
+        '''
+        BBH of the group members against the organisms still missing
+        '''
+        if len(self._missingOrganisms(orthname)) == 0:
+            return True
+        
+        logger.debug('Additional search on missing organisms for'+
+                      ' ortholog %s'%orthname)
+        for otherprotein in self.groups.getProteins(orthname):
+            if otherprotein == seqid:
+                continue
+            neworg = self._prot2orgs[otherprotein]
+            if neworg == org:
+                continue
+            targets = self._missingOrganisms(orthname)
+            if len(targets) == 0:
+                break
+            
+            if otherprotein not in self._index[neworg]:
+                logger.error('%s not found!'%otherprotein)
+                return False
+            otherseq = self._index[neworg].getRecord(otherprotein)
+            
+            if not self._putBBH(('additional', otherprotein), otherseq,
+                                neworg, targets):
+                return False
+            results = self._waitBBH(('additional', otherprotein))
+            if results is None:
+                return False
+            for evenneworg in targets:
+                hit = results.get(evenneworg)
+                if hit:
+                    self.groups.addProtein(orthname, hit, evenneworg)
+        
+        return True
+    
+    def _extendGroups(self, checkpoint, done):
+        '''
+        Update mode: BBH of the existing groups against the new organisms
+        '''
+        names = [x for x in sorted(self.pangenome) if x not in done]
+        # Groups queued in advance
+        window = self.ncpus * 4
+        ahead = 0
+        
+        for i in xrange(len(names)):
+            orthname = names[i]
+            
+            while ahead < len(names) and ahead <= i + window:
+                first = self.groups.getProteins(names[ahead])[0]
+                firstorg = self._prot2orgs[first]
+                if not self._putBBH(('extend', names[ahead]),
+                                    self._index[firstorg].getRecord(first),
+                                    firstorg, self._neworgs):
+                    return False
+                ahead += 1
+            
+            if self.killed:
+                logger.debug('Exiting for a kill signal')
+                return
+            
+            seqid = self.groups.getProteins(orthname)[0]
+            org = self._prot2orgs[seqid]
+            
+            results = self._waitBBH(('extend', orthname))
+            if results is None:
+                return False
+            for otherorg in self._neworgs:
+                hit = results.get(otherorg)
+                if hit:
+                    self.groups.addProtein(orthname, hit, otherorg)
+            
+            if not self._additionalSearch(orthname, seqid, org):
+                return False
+            
+            self._saveGroup(checkpoint, orthname)
+        
+        return True
+    
     def serialBBH(self):
-        orthindex = 1
+        '''
+        BBH for each protein against the other organisms
+        The worker pool is fed with the proteins ahead of the one being
+        grouped, so that the CPUs are kept busy
+        Each completed group is saved to a checkpoint file
+        In update mode, only the new organisms are searched
+        '''
+        self._orthindex = 1
+        
+        loaded = set()
+        if self.recover:
+            loaded = self.loadCheckpoint()
+            if len(loaded) > 0:
+                logger.info('Resuming the pangenome from %d groups'%
+                            len(loaded))
         
-        self._maxsubstatus = len(self._prot2orgs)
+        if os.path.exists(self._checkpoint):
+            checkpoint = open(self._checkpoint, 'a')
+        else:
+            checkpoint = open(self._checkpoint, 'w')
+            checkpoint.write(self._checkpointHeader() + '\n')
         
+        self._pending = {}
+        self._results = {}
+        self._dropped = set()
+        
+        proteins = [(org, seqid) for org in self._neworgs
+                    for seqid in self._orgprots[org]]
+        
+        self._maxsubstatus = len(proteins)
+        
+        if self.pangenome:
+            if not self._extendGroups(checkpoint, loaded):
+                return False
+        
+        # Proteins queued in advance
+        window = self.ncpus * 4
+        ahead = 0
+        
+        for i in xrange(len(proteins)):
+            org, seqid = proteins[i]
+            
+            while ahead < len(proteins) and ahead <= i + window:
+                aheadorg, aheadid = proteins[ahead]
+                if aheadid not in self.groups:
+                    aheadseq = self._index[aheadorg].getRecord(aheadid)
+                    if not self._putBBH(('seed', aheadid), aheadseq,
+                                     aheadorg,
+                                     [x for x in self._neworgs
+                                      if x != aheadorg]):
+                        return False
+                ahead += 1
+            
+            self._substatus += 1
+            self.updateStatus(sub=True)
+            
+            if self.killed:
+                logger.debug('Exiting for a kill signal')
+                return
+            
+            if seqid in self.groups:
+                self._dropBBH(('seed', seqid))
+                continue
+            orthname = self._newGroup(seqid, org)
+            
+            results = self._waitBBH(('seed', seqid))
+            if results is None:
+                return False
+            for otherorg in self._neworgs:
+                hit = results.get(otherorg)
+                if hit:
+                    self.groups.addProtein(orthname, hit, otherorg)
+            
+            if not self._additionalSearch(orthname, seqid, org):
+                return False
+            
+            self._saveGroup(checkpoint, orthname)
+        
+        checkpoint.close()
+        
+        if self.prefilter:
+            logger.info('Prefilter: %d Blast BBHs avoided out of %d'%
+                        (self.prefilterStats['avoided'],
+                         self.prefilterStats['pairs']))
+            logger.info('Prefilter recall check: %d BBHs found in %d '%
+                        (self.prefilterStats['missed'],
+                         self.prefilterStats['checked'])+
+                        'filtered pairs searched anyway')
+            if self.prefilterStats['missed'] > 0 and self.checkevery > 1:
+                logger.warning('The prefilter has discarded %d BBHs: '%
+                               self.prefilterStats['missed']+
+                               'some orthologs may be missing')
+        
+        return True
+    
+    def _getBestHits(self, fname):
+        '''
+        Parse a tabular Blast output, returning a dictionary
+        query --> best hit
+        '''
+        best = {}
+        for hits in self._blast.getTabularHits(fname, self.evalue):
+            if len(hits) == 0:
+                continue
+            best[stripLocalID(hits[0].query_id)] = stripLocalID(hits[0].hit)
+        return best
+    
+    def _checkManifest(self):
+        '''
+        The all-vs-all Blast outputs are named after the organisms indexes:
+        they are reused only if the organisms (and their proteomes),
+        their order and the Blast parameters are the same
+        Otherwise the old outputs are removed
+        '''
+        manifest = os.path.join(self._pangenomeroom, 'allblast.manifest')
+        
+        lines = ['\t'.join(['#', self.backend, str(self.evalue),
+                            self.matrix])]
+        for org in self.organisms:
+            checksum = hashlib.sha1()
+            f = open(org, 'rb')
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                checksum.update(chunk)
+            f.close()
+            lines.append('\t'.join([os.path.abspath(org),
+                                    checksum.hexdigest()]))
+        content = '\n'.join(lines) + '\n'
+        
+        if os.path.exists(manifest):
+            if self.recover and open(manifest).read() == content:
+                return
+            if self.recover:
+                logger.warning('Blast outputs in %s refer to a different '%
+                               self._pangenomeroom+
+                               'analysis: they will be computed again')
+        
+        for fname in os.listdir(self._pangenomeroom):
+            if fname.endswith('.tab'):
+                os.remove(os.path.join(self._pangenomeroom, fname))
+        
+        f = open(manifest, 'w')
+        f.write(content)
+        f.close()
+    
+    def allBlast(self):
+        '''
+        Run one Blast search for each ordered organisms pair
+        (whole proteome against the other organism DB)
+        Returns a dictionary (source, target) --> query --> best hit
+        or None if something went wrong
+        '''
+        # Split each proteome in normal and short proteins
+        queries = {}
+        for org in self.organisms:
+            orgindex = self.organisms.index(org)
+            normal = os.path.join(self._pangenomeroom, '%d.faa'%orgindex)
+            short = os.path.join(self._pangenomeroom, '%d_short.faa'%orgindex)
+            fnormal = open(normal, 'w')
+            fshort = open(short, 'w')
+            nnormal, nshort = 0, 0
+            for seq in SeqIO.parse(open(org),'fasta'):
+                if len(seq) < 30:
+                    SeqIO.write([seq], fshort, 'fasta')
+                    nshort += 1
+                else:
+                    SeqIO.write([seq], fnormal, 'fasta')
+                    nnormal += 1
+            fnormal.close()
+            fshort.close()
+            
+            queries[org] = []
+            if nnormal > 0:
+                queries[org].append((normal, False))
+            if nshort > 0:
+                queries[org].append((short, True))
+        
+        self._checkManifest()
+        
+        tasks = []
+        for org in self.organisms:
+            for otherorg in self.organisms:
+                if org == otherorg:
+                    continue
+                # Update mode: pairs of old organisms are already done
+                if (org not in self._neworgs and
+                    otherorg not in self._neworgs):
+                    continue
+                for query, short in queries[org]:
+                    out = '%s_%d.tab'%(os.path.splitext(query)[0],
+                                       self.organisms.index(otherorg))
+                    tasks.append((query, otherorg, org, out, short))
+        
+        # Spare CPUs are given to the single Blast runs
+        threads = max(1, self.ncpus / max(1, len(tasks)))
+        
+        self._maxsubstatus = len(tasks)
+        
+        best = {}
         for org in self.organisms:
-            seqs = [seq for seq in SeqIO.parse(open(org),'fasta')]
-            # Iterate over each protein
-            for seq in seqs:
+            for otherorg in self.organisms:
+                if org == otherorg:
+                    continue
+                if (org not in self._neworgs and
+                    otherorg not in self._neworgs):
+                    continue
+                best[(org, otherorg)] = {}
+        
+        queued = 0
+        for query, otherorg, org, out, short in tasks:
+            # Outputs are only present if the Blast run was completed
+            if self.recover and os.path.exists(out):
+                logger.debug('Reusing Blast output %s'%out)
                 self._substatus += 1
                 self.updateStatus(sub=True)
-                
-                if seq.id in self._already:
+                best[(org, otherorg)].update(self._getBestHits(out))
+                continue
+            
+            obj = RunAllBlast(query, self.dbs[otherorg], org, otherorg, out,
+                              self.evalue, self.matrix, short=short,
+                              ncpus=threads, backend=self.backend)
+            self._paralleltasks.put(obj)
+            queued += 1
+        
+        done = 0
+        while done < queued:
+            if self.killed:
+                logger.debug('Exiting for a kill signal')
+                return
+            
+            if self._parallelresults.empty():
+                self.sleeper.sleep(0.1)
+                continue
+            
+            self._substatus += 1
+            self.updateStatus(sub=True)
+            
+            org, otherorg, out, res = self._parallelresults.get()
+            done += 1
+            
+            if not res:
+                logger.error('An error occurred for Blast on %s'%org+
+                             ' against %s'%otherorg)
+                return
+            best[(org, otherorg)].update(self._getBestHits(out))
+        
+        return best
+    
+    def batchBBH(self):
+        '''
+        Same as serialBBH, but the BBHs are derived in memory
+        from the all-vs-all Blast results
+        '''
+        best = self.allBlast()
+        if best is None:
+            return False
+        
+        # Bidirectional best hits
+        # protein --> organism --> protein
+        bbh = {}
+        for org, otherorg in best:
+            for query, hit in best[(org, otherorg)].iteritems():
+                if best[(otherorg, org)].get(hit) != query:
                     continue
-                orthname = self.prefix + str(orthindex)
-                orgsincluded = [org]
-                self.orthologs[orthname] = [seq.id]
-                query = os.path.join(self._pangenomeroom,str(self._substatus))
-                if SeqIO.write([seq], open(query,'w'), 'fasta') <= 0:
-                    logger.error('Error writing sequence %s to file'%seq.id)
-                    return False
-                
-                self.initiateParallel()
-                
-                # Iterate over each other organism
-                for otherorg in self.organisms:
-                    if org == otherorg:
-                        continue
-                    # Go fot it!
-                    if len(seq) < 30:
-                        short = True
-                    else:
-                        short = False
-                    
-                    uniqueid = self.getUniqueID()
-                    
-                    # Multi process
-                    obj = RunBBH(query,seq.id,self.dbs[org],
-                            self.dbs[otherorg],otherorg,
-                            self.evalue,self.matrix,short=short,
-                            uniqueid=uniqueid)
-                    self._paralleltasks.put(obj)
-                    
-                # Poison pill to stop the workers
-                self.addPoison()
-                
-                while True:
-                    if self.killed:
-                        logger.debug('Exiting for a kill signal')
-                        return
-                         
-                    while not self._parallelresults.empty():
-                        if self.killed:
-                            logger.debug('Exiting for a kill signal')
-                            return
-                        
-                        result = self._parallelresults.get()
-                        
-                        if not result[2]:
-                            logger.error('An error occurred for BBH on query %s'%seq.id+
-                                         ' and target %s'%result[1])
-                            return False
-                        if result[0] and result[0] not in self._already:
-                            self.orthologs[orthname].append(result[0])
-                            orgsincluded.append(result[1])
-                            self._already.append(result[0])
-                            
-                    if self.isTerminated():
-                        break
-                    
-                    self.sleeper.sleep(0.1)
-                    
-                while not self._parallelresults.empty():
-                    if self.killed:
-                        logger.debug('Exiting for a kill signal')
-                        return
-                    
-                    result = self._parallelresults.get()
-                    
-                    if not result[2]:
-                        logger.error('An error occurred for BBH on query %s'%seq.id+
-                                     ' and target %s'%result[1])
-                        return False
-                    if result[0] and result[0] not in self._already:
-                        self.orthologs[orthname].append(result[0])
-                        orgsincluded.append(result[1])
-                        self._already.append(result[0])
-                
-                self.killParallel()
+                bbh[query] = bbh.get(query, {})
+                bbh[query][otherorg] = hit
+        
+        self._orthindex = 1
+        
+        # Update mode: existing groups first
+        if self.pangenome:
+            for orthname in sorted(self.pangenome):
+                if self.killed:
+                    logger.debug('Exiting for a kill signal')
+                    return
                 
-                if len(orgsincluded) < len(self.organisms):
-                    logger.debug('Additional search on missing organisms for'+
-                                  ' ortholog %s'%orthname)
-                    for otherprotein in self.orthologs[orthname]:
-                        if otherprotein == seq.id:
-                            continue
-                        neworg = self._prot2orgs[otherprotein]
-                        if neworg == org:
-                            continue
-                        bFound = False
-                        for seq in SeqIO.parse(open(neworg),'fasta'):
-                            if seq.id == otherprotein:
-                                bFound = True
-                                break
-                        if not bFound:
-                            logger.error('%s not found!'%otherprotein)
-                            return False
-                        if SeqIO.write([seq], open(query,'w'), 'fasta') == 0:
-                            logger.error('Error writing sequence %s to file'
-                                         %seq.id)
-                            return False
-                        
-                        self.initiateParallel()
-                        
-                        for evenneworg in self.organisms:
-                            if evenneworg in orgsincluded:
-                                continue
-                            # Go fot it!
-                            if len(seq) < 30:
-                                short = True
-                            else:
-                                short = False
-                            
-                            uniqueid = self.getUniqueID()
-                    
-                            # Multi process
-                            obj = RunBBH(query,otherprotein,self.dbs[neworg],
-                                    self.dbs[evenneworg],evenneworg,
-                                    self.evalue,self.matrix,short=short,uniqueid=uniqueid)
-                            self._paralleltasks.put(obj)
-                            
-                        # Poison pill to stop the workers
-                        self.addPoison()
-                        
-                        while True:
-                            if self.killed:
-                                logger.debug('Exiting for a kill signal')
-                                return
-                            
-                            while not self._parallelresults.empty():
-                                if self.killed:
-                                    logger.debug('Exiting for a kill signal')
-                                    return
-                                
-                                result = self._parallelresults.get()
-                                
-                                if not result[2]:
-                                    logger.error('An error occurred for BBH on query %s'%seq.id+
-                                                 ' and target %s'%result[1])
-                                    return False
-                                if result[0] and result[0] not in self._already:
-                                    self.orthologs[orthname].append(result[0])
-                                    orgsincluded.append(result[1])
-                                    self._already.append(result[0])
-                            
-                            if self.isTerminated():
-                                break
-                            
-                            self.sleeper.sleep(0.1)
-                        
-                        while not self._parallelresults.empty():
-                            if self.killed:
-                                logger.debug('Exiting for a kill signal')
-                                return
-                            
-                            result = self._parallelresults.get()
-                            
-                            if not result[2]:
-                                logger.error('An error occurred for BBH on query %s'%seq.id+
-                                             ' and target %s'%result[1])
-                                return False
-                            if result[0] and result[0] not in self._already:
-                                self.orthologs[orthname].append(result[0])
-                                orgsincluded.append(result[1])
-                                self._already.append(result[0])
-                        
-                        self.killParallel()
+                seqid = self.groups.getProteins(orthname)[0]
+                self._fillGroup(orthname, seqid, self._prot2orgs[seqid], bbh)
+        
+        for org in self._neworgs:
+            for seqid in self._orgprots[org]:
+                if self.killed:
+                    logger.debug('Exiting for a kill signal')
+                    return
                 
-                os.remove(query)   
-                orthindex += 1
+                if seqid in self.groups:
+                    continue
+                orthname = self._newGroup(seqid, org)
+                self._fillGroup(orthname, seqid, org, bbh)
+        
+        return True
+    
+    def _fillGroup(self, orthname, seqid, org, bbh):
+        '''
+        Add the BBHs of a group's first protein, then perform the
+        additional search using the in-memory BBHs
+        '''
+        for otherorg in self._neworgs:
+            if org == otherorg:
+                continue
+            hit = bbh.get(seqid, {}).get(otherorg)
+            if hit:
+                self.groups.addProtein(orthname, hit, otherorg)
+        
+        if len(self._missingOrganisms(orthname)) == 0:
+            return
+        
+        logger.debug('Additional search on missing organisms for'+
+                      ' ortholog %s'%orthname)
+        for otherprotein in self.groups.getProteins(orthname):
+            if otherprotein == seqid:
+                continue
+            neworg = self._prot2orgs[otherprotein]
+            if neworg == org:
+                continue
+            
+            for evenneworg in self._missingOrganisms(orthname):
+                hit = bbh.get(otherprotein, {}).get(evenneworg)
+                if hit:
+                    self.groups.addProtein(orthname, hit, evenneworg)
+    
+    def getBBHEdges(self, best, protindex):
+        '''
+        Returns the BBH edges as an int32 array (n x 2) of proteins indexes
+        Each BBH is reported once
+        '''
+        edges = []
+        for org, otherorg in best:
+            if self.organisms.index(org) > self.organisms.index(otherorg):
+                continue
+            for query, hit in best[(org, otherorg)].iteritems():
+                if best[(otherorg, org)].get(hit) != query:
+                    continue
+                edges.append(protindex[query])
+                edges.append(protindex[hit])
+        
+        return np.array(edges, dtype=np.int32).reshape(-1, 2)
+    
+    def graphBBH(self):
+        '''
+        Ortholog groups as the connected components of the BBH graph
+        Groups are named after the sorted proteins IDs, so that the result
+        does not depend on the organisms order
+        '''
+        best = self.allBlast()
+        if best is None:
+            return False
+        
+        prots = [prot for org in self.organisms for prot in self._orgprots[org]]
+        protindex = dict([(prot, i) for i, prot in enumerate(prots)])
+        
+        self.edges = self.getBBHEdges(best, protindex)
+        logger.debug('%d BBH edges'%len(self.edges))
+        
+        if self.killed:
+            logger.debug('Exiting for a kill signal')
+            return
+        
+        graph = coo_matrix((np.ones(len(self.edges), dtype=np.int8),
+                            (self.edges[:,0], self.edges[:,1])),
+                           shape=(len(prots), len(prots)))
+        ncomponents, labels = connected_components(graph, directed=False)
+        
+        components = [[] for i in xrange(ncomponents)]
+        for i in xrange(len(prots)):
+            components[labels[i]].append(prots[i])
+        components = sorted([sorted(x) for x in components])
+        
+        orthindex = 1
+        for members in components:
+            orthname = self.prefix + str(orthindex)
+            self.groups.newGroup(orthname, members[0],
+                                 self._prot2orgs[members[0]])
+            for prot in members[1:]:
+                self.groups.addProtein(orthname, prot, self._prot2orgs[prot])
+            orthindex += 1
+        
         return True
     
     def packPanGenome(self):
+        # By organisms, not proteins: groups may contain paralogs
         for g in self.orthologs:
-            if len(self.orthologs[g]) == len(self.organisms):
+            norgs = len(self.groups.getOrganisms(g))
+            if norgs == len(self.organisms):
                 self.core.append(g)
-            elif len(self.orthologs[g]) == 1:
+            elif norgs == 1:
                 self.unique.append(g)
             else:
                 self.accessory.append(g)
     
     def run(self):
+        self._resumable = False
+        try:
+            self.runPanGenome()
+        finally:
+            # The scratch files are kept only if the run can be resumed
+            if self._inscratch and not self._resumable:
+                shutil.rmtree(self._pangenomeroom, True)
+    
+    def runPanGenome(self):
         self.updateStatus()
+        if not self.recover:
+            # Start from a clean slate
+            self.makeRoom()
+            self.cleanUp()
         self.makeRoom()
         
         if self.killed:
@@ -326,15 +979,35 @@ class PanGenomer(CommonMultiProcess):
             return
         self.resetSubStatus()
         
+        if self.graph and self.pangenome:
+            logger.warning('Graph clustering computes the whole pangenome: '+
+                           'the existing groups will be ignored')
+            self.pangenome = None
+        if not self.loadPanGenome():
+            self.sendFailure('Existing pangenome could not be loaded!')
+            self.cleanUp()
+            return
+        
         if self.killed:
             return
             
         self.updateStatus()
-        if not self.serialBBH():
+        # A single worker pool for the whole run
+        self._resumable = True
+        self.initiateParallel()
+        if self.graph:
+            res = self.graphBBH()
+        elif self.batch:
+            res = self.batchBBH()
+        else:
+            res = self.serialBBH()
+        self.addPoison()
+        self.killParallel()
+        if not res:
+            # Temporary files are kept, to allow a resume
             self.sendFailure('Serial BBH failure!')
-            self.killParallel()
-            self.cleanUp()
             return
+        self._resumable = False
         self.resetSubStatus()
         
         if self.killed:
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Prefilter
+
+Genome library
+
+Spaced k-mer index of a proteome, used to avoid Blast runs between proteins
+that can't share any homology
+"""
+from Bio import SeqIO
+import logging
+import numpy as np
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Log setup
+
+logger = logging.getLogger('ductape.prefilter')
+
+################################################################################
+# Constants
+
+alphabet = 'ACDEFGHIKLMNPQRSTVWY'
+
+# Residue --> code (ambiguous residues are left out)
+_codes = np.empty(256, dtype=np.int64)
+_codes.fill(len(alphabet))
+for i, aa in enumerate(alphabet):
+    _codes[ord(aa)] = i
+
+# Spaced seed: only the residues marked with 1 are used, so that
+# a substitution in the other positions does not break the seed
+seedpattern = '11011'
+
+# Lowest identity of the homologs that should pass the prefilter
+minidentity = 0.5
+# Fraction of the seeds such homologs share that is required
+seedfraction = 0.35
+
+################################################################################
+# Classes
+
+class KmerIndex(object):
+    '''
+    Sorted array of the (spaced) k-mers of a proteome, with the index
+    of the protein each k-mer comes from
+    '''
+    def __init__(self, fasta, pattern=seedpattern):
+        self.fasta = fasta
+        self.pattern = pattern
+        # Seed span and number of residues used
+        self.span = len(pattern)
+        self.weight = pattern.count('1')
+        self.ids = []
+        self.kmers = None
+        self.prots = None
+        
+        self._build()
+    
+    def encode(self, sequence):
+        '''
+        Returns the (unique) k-mers codes of a protein sequence
+        k-mers with ambiguous residues are discarded
+        '''
+        residues = _codes[np.frombuffer(str(sequence).upper(), dtype=np.uint8)]
+        nkmers = len(residues) - self.span + 1
+        if nkmers <= 0:
+            return np.array([], dtype=np.int64)
+        
+        kmers = np.zeros(nkmers, dtype=np.int64)
+        valid = np.ones(nkmers, dtype=bool)
+        for i in range(self.span):
+            if self.pattern[i] != '1':
+                continue
+            window = residues[i:i + nkmers]
+            kmers = kmers * len(alphabet) + window
+            valid &= window < len(alphabet)
+        
+        return np.unique(kmers[valid])
+    
+    def _build(self):
+        kmers = []
+        prots = []
+        for seq in SeqIO.parse(open(self.fasta), 'fasta'):
+            codes = self.encode(seq.seq)
+            kmers.append(codes)
+            prots.append(np.empty(len(codes), dtype=np.int32))
+            prots[-1].fill(len(self.ids))
+            self.ids.append(seq.id)
+        
+        if len(kmers) == 0:
+            self.kmers = np.array([], dtype=np.int64)
+            self.prots = np.array([], dtype=np.int32)
+            return
+        
+        kmers = np.concatenate(kmers)
+        prots = np.concatenate(prots)
+        order = np.argsort(kmers, kind='mergesort')
+        self.kmers = kmers[order]
+        self.prots = prots[order]
+        
+        logger.debug('Indexed %d k-mers from %s'%(len(self.kmers), self.fasta))
+    
+    def maxShared(self, sequence):
+        '''
+        Returns the highest number of k-mers shared between the sequence
+        and a single protein of the proteome
+        '''
+        codes = self.encode(sequence)
+        left = np.searchsorted(self.kmers, codes, side='left')
+        right = np.searchsorted(self.kmers, codes, side='right')
+        lengths = right - left
+        total = lengths.sum()
+        if total == 0:
+            return 0
+        
+        # Positions of all the matching k-mers
+        offsets = np.repeat(left - np.cumsum(lengths) + lengths, lengths)
+        positions = offsets + np.arange(total)
+        
+        return np.bincount(self.prots[positions]).max()
+    
+    def getMinSeeds(self, length):
+        '''
+        Seeds a protein must share with a query of the provided length:
+        a fraction of those expected for a homolog with minidentity
+        Queries too short to carry enough seeds get 0 (never filtered)
+        '''
+        expected = (length - self.span + 1) * minidentity ** self.weight
+        return max(int(seedfraction * expected), 0)
+    
+    def hasCandidates(self, sequence):
+        '''
+        True if at least one protein shares enough k-mers with the sequence
+        '''
+        minseeds = self.getMinSeeds(len(sequence))
+        if minseeds == 0:
+            return True
+        return self.maxShared(sequence) >= minseeds
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+SmithWaterman
+
+Genome library
+
+Pure python/NumPy Smith-Waterman search backend, meant for tests
+and small inputs: no external program is needed
+"""
+from Bio import SeqIO
+from Bio.SubsMat import MatrixInfo
+from StringIO import StringIO
+from ductape.genome.blast import SearchBackend, tabformat, getFastaIndex, \
+                                  stripLocalID
+import logging
+import math
+import numpy as np
+import os
+import shutil
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Log setup
+
+logger = logging.getLogger('ductape.smithwaterman')
+
+################################################################################
+# Constants
+
+alphabet = 'ARNDCQEGHILKMFPSTWYVBZX'
+
+# Residue --> code (unknown residues are treated as X)
+_codes = np.empty(256, dtype=np.int64)
+_codes.fill(alphabet.index('X'))
+for i, aa in enumerate(alphabet):
+    _codes[ord(aa)] = i
+
+# Affine gap costs (a gap of length k costs gapopen + k * gapextend)
+gapopen = 11
+gapextend = 1
+
+# Karlin-Altschul parameters (BLOSUM62, gap costs 11/1)
+klambda = 0.267
+kappa = 0.041
+
+# Default number of hits for each query
+maxtargets = 500
+
+# Loaded DBs, shared by the forked worker processes
+_dbs = {}
+
+################################################################################
+# Classes
+
+class SWDatabase(object):
+    '''
+    Sequences of a search DB, concatenated in a single array
+    Each sequence is preceded by a separator column, so that a query
+    can be aligned against the whole DB in one pass
+    '''
+    def __init__(self, fasta):
+        self.fasta = fasta
+        self.ids = []
+        self.titles = []
+        self.lengths = []
+        
+        codes = []
+        for seq in SeqIO.parse(open(fasta), 'fasta'):
+            self.ids.append(seq.id)
+            self.titles.append(seq.description)
+            self.lengths.append(len(seq))
+            # Separator
+            codes.append(np.array([-1], dtype=np.int64))
+            codes.append(encode(seq.seq))
+        
+        self.lengths = np.array(self.lengths, dtype=np.int64)
+        if len(codes) == 0:
+            self.codes = np.array([], dtype=np.int64)
+            self.starts = np.array([], dtype=np.int64)
+        else:
+            self.codes = np.concatenate(codes)
+            self.starts = np.flatnonzero(self.codes < 0)
+        # Sequence each column belongs to
+        self.segments = np.cumsum(self.codes < 0) - 1
+        self.size = int(self.lengths.sum())
+
+class SmithWatermanBackend(SearchBackend):
+    '''
+    Smith-Waterman local alignments (affine gaps) of each query
+    against all the DB sequences, no heuristics involved
+    The DB is just a copy of the fasta file; Blast-like bit scores
+    and e-values are computed from the alignment scores
+    '''
+    def createDB(self, seqFile, dbType, outFile, parseIDs=True,
+                 title='Generic Blast DB'):
+        if dbType != 'prot':
+            logger.warning('Only protein DBs are supported')
+            return False
+        try:
+            shutil.copyfile(seqFile, outFile + '.faa')
+        except IOError:
+            logger.warning('Could not create the DB %s'%outFile)
+            return False
+        return True
+    
+    def _getDB(self, db):
+        # Reloaded if the DB has been rebuilt in the meantime
+        mtime = os.path.getmtime(db + '.faa')
+        if db not in _dbs or _dbs[db][0] != mtime:
+            _dbs[db] = (mtime, SWDatabase(db + '.faa'))
+        return _dbs[db][1]
+    
+    def _getOptions(self, additional):
+        '''
+        Substitution matrix, DB size and maximum number of hits,
+        taken from the Blast additional options (if present)
+        '''
+        options = {'-matrix':'BLOSUM62', '-dbsize':None,
+                   '-max_target_seqs':maxtargets}
+        tokens = additional.split()
+        for i, token in enumerate(tokens[:-1]):
+            if token in options:
+                options[token] = tokens[i + 1]
+        
+        name = options['-matrix'].lower()
+        if not hasattr(MatrixInfo, name):
+            logger.warning('Unknown matrix %s, using BLOSUM62'%
+                           options['-matrix'])
+            name = 'blosum62'
+        matrix = getMatrix(getattr(MatrixInfo, name))
+        
+        dbsize = options['-dbsize']
+        if dbsize is not None:
+            dbsize = int(dbsize)
+        
+        return matrix, dbsize, int(options['-max_target_seqs'])
+    
+    def search(self, queryFile, db, outFile, evalue=10, task='', ncpus=1,
+               additional='', outfmt=tabformat):
+        out = self.searchPipe(open(queryFile).read(), db, evalue, task,
+                              ncpus, additional, outfmt)
+        if out is None:
+            return False
+        fout = open(outFile, 'w')
+        fout.write(out)
+        fout.close()
+        return True
+    
+    def searchPipe(self, query, db, evalue=10, task='', ncpus=1,
+                   additional='', outfmt=tabformat):
+        if outfmt != tabformat:
+            logger.warning('Only the tabular output is supported')
+            return None
+        
+        try:
+            sdb = self._getDB(db)
+        except (IOError, OSError):
+            logger.warning('Could not open the DB %s'%db)
+            return None
+        matrix, dbsize, maxhits = self._getOptions(additional)
+        if dbsize is None:
+            dbsize = sdb.size
+        
+        lines = []
+        for seq in SeqIO.parse(StringIO(query), 'fasta'):
+            scores = align(encode(seq.seq), sdb, matrix)
+            
+            bits = (klambda * scores - math.log(kappa)) / math.log(2)
+            evalues = len(seq) * float(dbsize) * np.power(2.0, -bits)
+            
+            # Best hits first
+            hits = np.flatnonzero((scores > 0) & (evalues <= evalue))
+            hits = hits[np.argsort(-scores[hits], kind='mergesort')]
+            for i in hits[:maxhits]:
+                lines.append('%s\t%s\t%d\t%d\t%.2g\t%.1f\t%s\n'%(seq.id,
+                                sdb.ids[i], len(seq), sdb.lengths[i],
+                                evalues[i], bits[i], sdb.titles[i]))
+        
+        return ''.join(lines)
+    
+    def fetchSequence(self, db, accession):
+        index = getFastaIndex(db + '.faa')
+        seqid = stripLocalID(accession)
+        if seqid not in index:
+            logger.warning('Sequence %s not found in %s'%(accession, db))
+            return None
+        return index.getRaw(seqid)
+
+################################################################################
+# Methods
+
+def encode(sequence):
+    '''
+    Sequence --> residue codes
+    '''
+    return _codes[np.frombuffer(str(sequence).upper(), dtype=np.uint8)]
+
+def getMatrix(scores):
+    '''
+    Substitution matrix (Bio.SubsMat.MatrixInfo dictionary) as an array,
+    with an extra row/column for the separators
+    '''
+    size = len(alphabet)
+    matrix = np.zeros((size, size + 1), dtype=np.int64)
+    for i, a in enumerate(alphabet):
+        for j, b in enumerate(alphabet):
+            matrix[i, j] = scores.get((a, b), scores.get((b, a), -4))
+    # Separators: no alignment can go through them
+    matrix[:, size] = -(1 << 20)
+    return matrix
+
+def align(query, sdb, matrix):
+    '''
+    Best local alignment score of the query against each DB sequence
+    (Gotoh recursion, one query residue at a time against the whole DB)
+    
+    Horizontal gaps are computed from the scores without them, with a
+    running maximum; each DB sequence gets its own offset, so that gaps
+    can't cross the separators
+    '''
+    ncols = len(sdb.codes)
+    if ncols == 0 or len(query) == 0:
+        return np.zeros(len(sdb.ids), dtype=np.int64)
+    
+    columns = sdb.codes.copy()
+    columns[columns < 0] = matrix.shape[1] - 1
+    positions = np.arange(ncols, dtype=np.int64)
+    offsets = sdb.segments * (1 << 40)
+    
+    H = np.zeros(ncols, dtype=np.int64)
+    E = np.zeros(ncols, dtype=np.int64)
+    best = np.zeros(ncols, dtype=np.int64)
+    for residue in query:
+        scores = matrix[residue][columns]
+        # Vertical gaps
+        E = np.maximum(E - gapextend, H - gapopen - gapextend)
+        # Diagonal
+        diagonal = np.empty(ncols, dtype=np.int64)
+        diagonal[0] = 0
+        diagonal[1:] = H[:-1]
+        diagonal += scores
+        Htmp = np.maximum(np.maximum(diagonal, E), 0)
+        # Horizontal gaps
+        running = np.maximum.accumulate(Htmp + gapextend * positions +
+                                        offsets)
+        F = np.empty(ncols, dtype=np.int64)
+        F[0] = -gapopen
+        F[1:] = (running[:-1] - offsets[1:] -
+                 gapopen - gapextend * positions[1:])
+        H = np.maximum(Htmp, F)
+        H[sdb.starts] = 0
+        best = np.maximum(best, H)
+    
+    return np.maximum.reduceat(best, sdb.starts)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Cache
+
+Common Library
+
+KeggCache stores the KEGG API responses in a SQLite file, shared by
+all the projects, so that the same entries are not requested again
+"""
+import cPickle
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Log setup
+
+logger = logging.getLogger('ductape.cache')
+
+################################################################################
+# Constants
+
+# Shared by all the projects of the user
+defaultCache = os.path.join(os.path.expanduser('~'), '.ductape',
+                            'keggcache.db')
+
+# Responses older than this (days) are requested again
+defaultTTL = 30
+
+# Seconds to wait for a lock held by another process
+cachetimeout = 120
+
+################################################################################
+# Classes
+
+class KeggCacheMiss(Exception):
+    '''
+    Raised in offline mode when a response is not in the cache
+    '''
+    pass
+
+class KeggEntry(object):
+    '''
+    Class KeggEntry
+    Plain copy of a KEGG API structure (i.e. a linkdb entry),
+    with the same attributes, so that it can be stored
+    '''
+    def __init__(self, fields):
+        for field, value in fields.iteritems():
+            self.__setattr__(field, value)
+
+class KeggCache(object):
+    '''
+    Class KeggCache
+    KEGG API responses, keyed by method and arguments
+    Responses older than ttl (days) are treated as misses, unless the
+    cache is offline: then the stale ones are used as well, and a miss
+    raises a KeggCacheMiss exception instead of contacting KEGG
+    Thread-safe: each thread gets its own connection
+    '''
+    def __init__(self, dbname=defaultCache, ttl=defaultTTL, offline=False):
+        self.dbname = dbname
+        self.ttl = ttl
+        self.offline = bool(offline)
+        
+        self.hits = 0
+        self.misses = 0
+        
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        
+        path = os.path.dirname(os.path.abspath(self.dbname))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        
+        with self._getConnection() as conn:
+            conn.execute('''create table if not exists response (
+                            key text primary key,
+                            value blob,
+                            stamp real);''')
+    
+    def _getConnection(self):
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = sqlite3.connect(self.dbname,
+                                                     timeout=cachetimeout)
+        return self._local.connection
+    
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+    
+    def getKey(self, method, args):
+        return '\t'.join([method] + [str(x) for x in args])
+    
+    def get(self, method, args):
+        '''
+        Returns a tuple (hit, response)
+        '''
+        key = self.getKey(method, args)
+        with self._getConnection() as conn:
+            cursor=conn.execute('select value, stamp from response where key=?;',
+                                [key,])
+        data = cursor.fetchall()
+        
+        if len(data) == 0:
+            self._count(False)
+            if self.offline:
+                raise KeggCacheMiss('%s is not in the KEGG cache'%key)
+            return False, None
+        
+        value, stamp = data[0]
+        if not self.offline and time.time() - stamp > self.ttl * 86400:
+            logger.debug('Expired KEGG cache entry %s'%key)
+            self._count(False)
+            return False, None
+        
+        self._count(True)
+        return True, cPickle.loads(str(value))
+    
+    def put(self, method, args, response):
+        '''
+        Store a response; the KEGG API structures are stored as
+        KeggEntry objects
+        '''
+        key = self.getKey(method, args)
+        # Any sequence (i.e. a SOAP array) is stored as a plain list
+        if (hasattr(response, '__iter__') and
+            not isinstance(response, (basestring, dict))):
+            response = [KeggEntry(x._asdict()) if hasattr(x, '_asdict')
+                        else x for x in response]
+        elif hasattr(response, '_asdict'):
+            response = KeggEntry(response._asdict())
+        try:
+            value = cPickle.dumps(response, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            logger.debug('Could not store %s in the KEGG cache: %s'%(key, e))
+            return
+        
+        with self._getConnection() as conn:
+            conn.execute('insert or replace into response values (?,?,?);',
+                         [key, sqlite3.Binary(value), time.time(),])
+    
+    def getStats(self):
+        '''
+        Returns a tuple (hits, misses)
+        '''
+        return self.hits, self.misses
+
+################################################################################
+# Methods
+
+def getKeggCache(dbname=defaultCache, ttl=defaultTTL, offline=False):
+    '''
+    Open the KEGG responses cache (None if disabled or unavailable)
+    '''
+    if not dbname:
+        if offline:
+            logger.warning('Offline mode ignored: the KEGG cache is disabled')
+        return None
+    
+    try:
+        return KeggCache(dbname, ttl, offline)
+    except Exception, e:
+        logger.warning('Could not open the KEGG cache %s (%s)'%(dbname, e))
+        return None
@@ -10,9 +10,12 @@ KoMapper handles reactions, pathways and compounds retrieval on Ko IDs
 from SOAPpy import WSDL
 from ductape.common.commonthread import CommonThread
 from ductape.common.utils import get_span
+from ductape.kegg.cache import KeggCacheMiss
 from ductape.kegg.web import kheader
 import Queue
+import functools
 import logging
+import math
 import os
 import shutil
 import threading
@@ -26,6 +29,12 @@ __author__ = "Marco Galardini"
 
 logger = logging.getLogger('ductape.kegg')
 
+################################################################################
+# Constants
+
+# Maximum number of entries in a single btit request
+titlesBatch = 100
+
 ################################################################################
 # Classes
 
@@ -53,16 +62,38 @@ class MapParser(object):
             
         return self.map
 
+def cached(method):
+    '''
+    KeggAPI methods decorator: the response is taken from the cache
+    (if any), otherwise the request is sent and its response stored
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        
+        hit, response = self.cache.get(method.__name__, args)
+        if hit:
+            self.input = args[0]
+            self.result = response
+            return
+        
+        method(self, *args, **kwargs)
+        self.cache.put(method.__name__, args, self.result)
+    return wrapper
+
 class KeggAPI(object):
     '''
     Class KeggAPI
     Connects to KEGG API and performs various tasks
     Fail-safe: if a request fails it tries again and again
     All the results are stored in the attribute result, as well as the inputs
+    If a KeggCache is provided, the responses are looked for there first
     '''
-    def __init__(self):
+    def __init__(self, cache=None):
         self._apiurl = 'http://soap.genome.jp/KEGG.wsdl'
         self._keggserv = None
+        self.cache = cache
         self.clean()
     
     def clean(self):
@@ -75,6 +106,11 @@ class KeggAPI(object):
         If it fails it tries again (retries)
         Returns True if it worked, False otherwise
         '''
+        if self.cache is not None and self.cache.offline:
+            logger.debug('Offline: KEGG API won\'t be contacted')
+            self.result = True
+            return
+        
         logger.debug('KEPP API url: %s'%self._apiurl)
         attempts = 0
         while True:
@@ -94,6 +130,7 @@ class KeggAPI(object):
                     self.result = False
                     return
 
+    @cached
     def getTitle(self, entry, retries=5):
         '''
         Get the title of a specific KEGG object
@@ -121,6 +158,71 @@ class KeggAPI(object):
                     logger.warning('btit failed!')
                     raise Exception('btit request failed')
     
+    def getTitles(self, entries, retries=5):
+        '''
+        Get the titles of many KEGG objects with a single btit request
+        (up to titlesBatch entries)
+        Returns a dictionary entry --> title, as in getTitle
+        The cache is shared with getTitle: only the missing entries
+        are requested
+        '''
+        self.input = entries
+        self.result = {}
+        
+        missing = []
+        for entry in entries:
+            if self.cache is not None:
+                hit, title = self.cache.get('getTitle', (entry,))
+                if hit:
+                    self.result[entry] = title
+                    continue
+            missing.append(entry)
+        
+        if len(missing) == 0:
+            return
+        
+        # KEGG may change the IDs case
+        ids = dict([(x.lower(), x) for x in missing])
+        
+        attempts = 0
+        while True:
+            try:
+                logger.debug('Looking for titles for %d KEGG entries'%
+                             len(missing))
+                res = self._keggserv.btit(' '.join(missing)).strip()
+                titles = {}
+                for line in res.split('\n'):
+                    line = line.strip()
+                    if line == '':
+                        continue
+                    entry = ids.get(line.split(' ')[0].lower())
+                    if entry is None:
+                        continue
+                    start = line.split(';')
+                    name = ' '.join(start[0].split(' ')[1:])
+                    if len(start) > 1:
+                        descr = ';'.join(start[1:])
+                    else: descr = ''
+                    titles[entry] = [name, descr]
+                break
+            except Exception, e:
+                attempts += 1
+                logger.debug('btit failed! Attempt %d'
+                              %attempts)
+                logger.debug('%s'%str(e))
+                time.sleep(2*attempts)
+                if attempts >= retries:
+                    logger.warning('btit failed!')
+                    raise Exception('btit request failed')
+        
+        for entry in missing:
+            # Unknown entries get an empty title, as in getTitle
+            title = titles.get(entry, ['', ''])
+            self.result[entry] = title
+            if self.cache is not None:
+                self.cache.put('getTitle', (entry,), title)
+    
+    @cached
     def getReactions(self, ko_id, retries=5):
         '''
         Get the reaction IDs for a given KO entry
@@ -130,7 +232,8 @@ class KeggAPI(object):
             try:
                 self.input = ko_id
                 logger.debug('Looking for KEGG reactions from %s'%ko_id)
-                self.result = self._keggserv.get_linkdb_by_entry(ko_id, 'reaction')
+                self.result = list(self._keggserv.get_linkdb_by_entry(ko_id,
+                                                                'reaction'))
                 return
             except Exception, e:
                 attempts += 1
@@ -142,6 +245,7 @@ class KeggAPI(object):
                     logger.warning('get_linkdb_by_entry failed!')
                     raise Exception('get_linkdb_by_entry request failed')
                 
+    @cached
     def getPathways(self, re_id, retries=5):
         '''
         Get the pathway IDs for a given reaction
@@ -163,6 +267,7 @@ class KeggAPI(object):
                     logger.warning('get_pathways_by_reactions failed!')
                     raise Exception('get_pathways_by_reactions request failed')
     
+    @cached
     def getReactionsByComp(self, co_id, retries=5):
         '''
         Get the reactions IDs for a given compound
@@ -184,6 +289,7 @@ class KeggAPI(object):
                     logger.warning('get_reactions_by_compound failed!')
                     raise Exception('get_reactions_by_compound request failed')
     
+    @cached
     def getReactionsFromPath(self, path_id, retries=5):
         '''
         Get the reaction IDs for a given pathway
@@ -205,6 +311,7 @@ class KeggAPI(object):
                     logger.warning('get_reactions_by_pathway failed!')
                     raise Exception('get_reactions_by_pathway request failed')
     
+    @cached
     def getCompoundsFromReaction(self, re_id, retries=5):
         '''
         Get the compound IDs for a given reaction
@@ -226,6 +333,7 @@ class KeggAPI(object):
                     logger.warning('get_compounds_by_reaction failed!')
                     raise Exception('get_compounds_by_reaction request failed')
     
+    @cached
     def getCompoundsFromPath(self, path_id, retries=5):
         '''
         Get the compound IDs for a given pathway
@@ -299,11 +407,23 @@ class KeggAPI(object):
                     logger.warning('get_html_of_colored_pathway_by_objects failed!')
                     raise Exception('get_html_of_colored_pathway_by_objects request failed')
                 
+    @cached
+    def getPathwayMap(self, path_id, retries=5):
+        '''
+        Get the content of the plain (not colored) pathway map
+        If it fails, an exception is thrown
+        '''
+        self.getHTMLColoredPathway(path_id, [], [], retries)
+    
     def getHTMLColoredPathway(self, path_id, obj_list, color_list, retries=5):
         '''
         Get the URL of the colored pathway and return its content
+        Colored maps are never cached
         If it fails, an exception is thrown
         '''
+        if self.cache is not None and self.cache.offline:
+            raise KeggCacheMiss('Colored map %s needs KEGG API'%path_id)
+        
         attempts = 0
         while True:
             try:
@@ -464,48 +584,165 @@ class KeggDetails(object):
     def getMaps(self):
         return self.pathmaps
 
+class KeggRequest(object):
+    '''
+    Class KeggRequest
+    A single request to KEGG API (method name and its arguments)
+    The first argument is the KEGG entry (or a list of entries, for the
+    batched requests); once the request has been sent
+    the result (or the exception raised) is stored in the attributes
+    '''
+    def __init__(self, method, args):
+        self.method = method
+        self.args = args
+        self.entry = args[0]
+        # Batched requests carry a list of entries
+        if type(self.entry) == list:
+            self.size = len(self.entry)
+        else:
+            self.size = 1
+        
+        self.result = None
+        self.exception = None
+    
+    def send(self, handler):
+        handler.clean()
+        try:
+            getattr(handler, self.method)(*self.args)
+            self.result = handler.result
+        except Exception, e:
+            self.exception = e
+
+class KeggWorker(threading.Thread):
+    '''
+    Class KeggWorker
+    Sends the requests found in the tasks queue through its own KEGG API
+    handler, until a None is found
+    Each sent request is put in the done queue
+    '''
+    def __init__(self, handler, tasks, done):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        
+        self.handler = handler
+        self.tasks = tasks
+        self.done = done
+    
+    def run(self):
+        while True:
+            request = self.tasks.get()
+            if request is None:
+                break
+            request.send(self.handler)
+            self.done.put(request)
+
 class BaseKegg(CommonThread):
-    def __init__(self, threads=5, queue=Queue.Queue()):
+    def __init__(self, threads=5, queue=Queue.Queue(), cache=None):
         CommonThread.__init__(self,queue)
         
         # Kegg connection
         self.handlers = []
         self.numThreads = threads
         
+        # Responses cache (KeggCache), shared by the handlers
+        self.cache = cache
+    
     def connect(self):
         '''
         Starts N connections to Kegg API
         Return False if something goes wrong
         '''
         for i in range(self.numThreads):
-            obj = KeggAPI()
+            obj = KeggAPI(self.cache)
             self.handlers.append(obj)
-            
+        
         self.cleanHandlers()
         threads = []
         for i in range(self.numThreads):
             obj = threading.Thread(target = self.handlers[i].connect)
             obj.start()
             threads.append(obj)
-        time.sleep(0.01)
-        while len(threads) > 0:
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return False
-            
-            for thread in threads:
-                if not thread.isAlive():
-                    threads.remove(thread)
-        return True
+        for thread in threads:
+            while thread.isAlive():
+                if self.killed:
+                    logger.debug('Exiting for a kill signal')
+                    return False
+                thread.join(0.5)
+        
+        # Only the connected handlers are kept
+        self.handlers = [x for x in self.handlers if x.result]
+        self.cleanHandlers()
+        return len(self.handlers) > 0
     
     def cleanHandlers(self):
         for handler in self.handlers:
             handler.clean()
-            
-class BaseMapper(BaseKegg):
-    def __init__(self, threads=5, avoid=[], queue=Queue.Queue()):
-        BaseKegg.__init__(self, threads=threads, queue=queue)
+    
+    def iterRequests(self, method, requests):
+        '''
+        Sends the requests (a list of arguments tuples for method)
+        to Kegg API, through a bounded pool of workers (one for each handler)
+        The requests are yielded as soon as they are done (entry, result),
+        so that a slow request does not hold up the others
+        Failed requests and empty results are skipped, apart from
+        the ones missing from an offline cache, which are raised
+        '''
+        tasks = Queue.Queue()
+        done = Queue.Queue()
+        
+        for args in requests:
+            tasks.put(KeggRequest(method, args))
+        
+        workers = []
+        for handler in self.handlers:
+            tasks.put(None)
+            obj = KeggWorker(handler, tasks, done)
+            obj.start()
+            workers.append(obj)
+        
+        try:
+            pending = len(requests)
+            while pending > 0:
+                if self.killed:
+                    logger.debug('Exiting for a kill signal')
+                    return
+                
+                try:
+                    request = done.get(timeout=0.5)
+                except Queue.Empty:
+                    continue
+                pending -= 1
+                
+                self._substatus += request.size
+                if self._substatus > self._maxsubstatus:
+                    self._substatus = self._maxsubstatus
+                if pending % self.numThreads == 0:
+                    self.updateStatus(sub=True)
+                
+                if isinstance(request.exception, KeggCacheMiss):
+                    raise request.exception
+                if request.exception is not None:
+                    logger.debug('Request %s(%s) failed: %s'%(request.method,
+                                                            request.entry,
+                                                            request.exception))
+                    continue
+                if not request.result:
+                    continue
+                yield request.entry, request.result
+        finally:
+            # The pending requests are dropped, the workers are stopped
+            while True:
+                try:
+                    tasks.get_nowait()
+                except Queue.Empty:
+                    break
+            for worker in workers:
+                tasks.put(None)
 
+class BaseMapper(BaseKegg):
+    def __init__(self, threads=5, avoid=[], queue=Queue.Queue(), cache=None):
+        BaseKegg.__init__(self, threads=threads, queue=queue, cache=cache)
+        
         # Skip these
         self.avoid = avoid
         
@@ -522,319 +759,102 @@ class BaseMapper(BaseKegg):
         
         # Output
         self.result = None
-        
+    
+    def getBatches(self, entries):
+        '''
+        Split the entries for the batched requests (up to titlesBatch
+        entries each), so that all the handlers are kept busy
+        '''
+        span = int(math.ceil(len(entries) / float(max(1, len(self.handlers)))))
+        span = max(1, min(titlesBatch, span))
+        return [(piece,) for piece in get_span(entries, span)]
+    
     def getReactDetails(self):
-        for piece in get_span(self.reactdet.keys(), self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for react in piece:
-                if react in self.avoid:
-                    continue
-                
-                obj = threading.Thread(
-                            target = self.handlers[piece.index(react)].getTitle,
-                            args = (react,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                self.reactdet[handler.input] = handler.result
-                
+        entries = [react for react in self.reactdet.keys()
+                   if react not in self.avoid]
+        requests = self.getBatches(entries)
+        for piece, result in self.iterRequests('getTitles', requests):
+            self.reactdet.update(result)
+    
     def getPathDetails(self):
-        for piece in get_span(self.pathdet.keys(), self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for path in piece:
-                if path in self.avoid:
-                    continue
-                
-                obj = threading.Thread(
-                            target = self.handlers[piece.index(path)].getTitle,
-                            args = (path,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                self.pathdet[handler.input] = handler.result
+        entries = [path for path in self.pathdet.keys()
+                   if path not in self.avoid]
+        requests = self.getBatches(entries)
+        for piece, result in self.iterRequests('getTitles', requests):
+            self.pathdet.update(result)
     
     def getMapsDetails(self):
-        for piece in get_span(self.pathdet.keys(), self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for path in piece:
-                if path in self.avoid:
-                    continue
-                
-                obj = threading.Thread(
-                            target = self.handlers[piece.index(path)].getHTMLColoredPathway,
-                        args = (path,[],[],))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                parser = MapParser(handler.result)
-                self.pathmap[handler.input] = parser.map
+        requests = [(path,) for path in self.pathdet.keys()
+                    if path not in self.avoid]
+        for path, result in self.iterRequests('getPathwayMap',
+                                              requests):
+            parser = MapParser(result)
+            self.pathmap[path] = parser.map
     
     def getPathReactions(self):
-        for piece in get_span(self.pathdet.keys(), self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for path in piece:
-                obj = threading.Thread(
-                            target = 
-                            self.handlers[piece.index(path)].getReactionsFromPath,
-                            args = (path,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                for react in handler.result:
-                    if handler.input not in self.pathreact:
-                        self.pathreact[handler.input] = []
-                    self.pathreact[handler.input].append(react)
-                    if react not in self.reactdet:
-                        self.reactdet[react] = None
-                        
+        requests = [(path,) for path in self.pathdet.keys()]
+        for path, result in self.iterRequests('getReactionsFromPath',
+                                              requests):
+            for react in result:
+                if path not in self.pathreact:
+                    self.pathreact[path] = []
+                self.pathreact[path].append(react)
+                if react not in self.reactdet:
+                    self.reactdet[react] = None
+    
     def getPathCompounds(self):
-        for piece in get_span(self.pathdet.keys(), self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for path in piece:
-                obj = threading.Thread(
-                            target = 
-                            self.handlers[piece.index(path)].getCompoundsFromPath,
-                            args = (path,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                for comp in handler.result:
-                    if handler.input not in self.pathcomp:
-                        self.pathcomp[handler.input] = []
-                    self.pathcomp[handler.input].append(comp)
-                    if comp not in self.compdet:
-                        self.compdet[comp] = None
-                        
+        requests = [(path,) for path in self.pathdet.keys()]
+        for path, result in self.iterRequests('getCompoundsFromPath',
+                                              requests):
+            for comp in result:
+                if path not in self.pathcomp:
+                    self.pathcomp[path] = []
+                self.pathcomp[path].append(comp)
+                if comp not in self.compdet:
+                    self.compdet[comp] = None
+    
     def getCompDetails(self):
-        for piece in get_span(self.compdet.keys(), self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for comp in piece:
-                obj = threading.Thread(
-                            target = self.handlers[piece.index(comp)].getTitle,
-                            args = (comp,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                self.compdet[handler.input] = handler.result
+        entries = self.compdet.keys()
+        requests = self.getBatches(entries)
+        for piece, result in self.iterRequests('getTitles', requests):
+            self.compdet.update(result)
     
     def getPathways(self):
-        for piece in get_span(self.reactdet.keys(), self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for react in piece:
-                obj = threading.Thread(
-                            target = self.handlers[piece.index(react)].getPathways,
-                            args = (react,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                if len(handler.result) == 0:
-                    continue
-                if handler.input not in self.reactpath:
-                    self.reactpath[handler.input] = []
-                for path in handler.result:
-                    self.reactpath[handler.input].append(path)
-                    # A new pathway?
-                    if path not in self.pathdet:
-                        self.pathdet[path] = None
-                        
+        requests = [(react,) for react in self.reactdet.keys()]
+        for react, result in self.iterRequests('getPathways', requests):
+            if react not in self.reactpath:
+                self.reactpath[react] = []
+            for path in result:
+                self.reactpath[react].append(path)
+                # A new pathway?
+                if path not in self.pathdet:
+                    self.pathdet[path] = None
+    
     def getReactCompounds(self):
-        for piece in get_span(self.reactdet.keys(), self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for react in piece:
-                if react in self.avoid:
-                    continue
-                
-                obj = threading.Thread(
-                            target = self.handlers[piece.index(react)].getCompoundsFromReaction,
-                            args = (react,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                if len(handler.result) == 0:
-                    continue
-                if handler.input not in self.reactcomp:
-                    self.reactcomp[handler.input] = []
-                for co_id in handler.result:
-                    self.reactcomp[handler.input].append(co_id)
-                    # A new compound?
-                    if co_id not in self.compdet:
-                        self.compdet[co_id] = None
-                        
+        requests = [(react,) for react in self.reactdet.keys()
+                    if react not in self.avoid]
+        for react, result in self.iterRequests('getCompoundsFromReaction',
+                                              requests):
+            if react not in self.reactcomp:
+                self.reactcomp[react] = []
+            for co_id in result:
+                self.reactcomp[react].append(co_id)
+                # A new compound?
+                if co_id not in self.compdet:
+                    self.compdet[co_id] = None
+    
     def getCompoundReacts(self):
-        for piece in get_span(self.compdet.keys(), self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for co_id in piece:
-                if co_id in self.avoid:
-                    continue
-                
-                obj = threading.Thread(
-                            target = self.handlers[piece.index(co_id)].getReactionsByComp,
-                            args = (co_id,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                if len(handler.result) == 0:
-                    continue
-                if handler.input not in self.compreact:
-                    self.compreact[handler.input] = []
-                for re_id in handler.result:
-                    self.compreact[handler.input].append(re_id)
-                    # A new reaction?
-                    if re_id not in self.reactdet:
-                        self.reactdet[re_id] = None
+        requests = [(co_id,) for co_id in self.compdet.keys()
+                    if co_id not in self.avoid]
+        for co_id, result in self.iterRequests('getReactionsByComp',
+                                               requests):
+            if co_id not in self.compreact:
+                self.compreact[co_id] = []
+            for re_id in result:
+                self.compreact[co_id].append(re_id)
+                # A new reaction?
+                if re_id not in self.reactdet:
+                    self.reactdet[re_id] = None
 
 class KoMapper(BaseMapper):
     '''
@@ -857,8 +877,10 @@ class KoMapper(BaseMapper):
     
     _substatuses = [2,3,4,5,6]
     
-    def __init__(self, ko_list, threads=20, avoid=[], queue=Queue.Queue()):
-        BaseMapper.__init__(self, threads=threads, avoid=avoid, queue=queue)
+    def __init__(self, ko_list, threads=20, avoid=[], queue=Queue.Queue(),
+                 cache=None):
+        BaseMapper.__init__(self, threads=threads, avoid=avoid, queue=queue,
+                            cache=cache)
         # Kegg
         self.ko = ko_list
         
@@ -867,76 +889,23 @@ class KoMapper(BaseMapper):
         self.koreact = {}
     
     def getKOdet(self):
-        for piece in get_span(self.ko, self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for ko in piece:
-                if ko in self.avoid:
-                    continue
-                
-                obj = threading.Thread(
-                            target = self.handlers[piece.index(ko)].getTitle,
-                            args = (ko,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                self.kodet[handler.input] = handler.result
-                
-    def getReactions(self):
-        for piece in get_span(self.ko, self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for ko in piece:
-                if ko in self.avoid:
-                    continue
-                
-                obj = threading.Thread(
-                            target = self.handlers[piece.index(ko)].getReactions,
-                            args = (ko,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                for react in handler.result:
-                    if 'original' in react.type:
-                        if handler.input not in self.koreact:
-                            self.koreact[handler.input] = []
-                        self.koreact[handler.input].append(react.entry_id2)
-                        # Is this reaction new?
-                        if react.entry_id2 not in self.reactdet:
-                            self.reactdet[react.entry_id2] = None
+        entries = [ko for ko in self.ko if ko not in self.avoid]
+        requests = self.getBatches(entries)
+        for piece, result in self.iterRequests('getTitles', requests):
+            self.kodet.update(result)
     
+    def getReactions(self):
+        requests = [(ko,) for ko in self.ko if ko not in self.avoid]
+        for ko, result in self.iterRequests('getReactions', requests):
+            for react in result:
+                if 'original' in react.type:
+                    if ko not in self.koreact:
+                        self.koreact[ko] = []
+                    self.koreact[ko].append(react.entry_id2)
+                    # Is this reaction new?
+                    if react.entry_id2 not in self.reactdet:
+                        self.reactdet[react.entry_id2] = None
+
     def run(self):
         self.updateStatus()
         if not self.connect():
@@ -1125,8 +1094,10 @@ class CompMapper(BaseMapper):
     
     _substatuses = [2,3,4,5,6]
     
-    def __init__(self, co_list, threads=20, avoid=[], queue=Queue.Queue()):
-        BaseMapper.__init__(self, threads=threads, avoid=avoid, queue=queue)
+    def __init__(self, co_list, threads=20, avoid=[], queue=Queue.Queue(),
+                 cache=None):
+        BaseMapper.__init__(self, threads=threads, avoid=avoid, queue=queue,
+                            cache=cache)
         # Kegg
         self.co = co_list
         
@@ -1359,42 +1330,15 @@ class MapsFetcher(BaseKegg):
     def getMaps(self):
         legend = self.copyLegend()
         
-        for piece in get_span(self.colors, self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for kmap in piece:
-                path = kmap.path
-                objs,colors = kmap.getAll()
-                
-                obj = threading.Thread(
-                        target = self.handlers[piece.index(kmap)].getColoredPathway,
-                        args = (path,objs,colors,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                fname = os.path.join(self._keggroom,handler.input)
-                fname = fname+'.png'
-                fOut = open(fname,'w')
-                fOut.write(handler.result)
-                fOut.close()
-                self.pics.append(fname)
-    
+        requests = [(kmap.path,) + kmap.getAll() for kmap in self.colors]
+        for path, result in self.iterRequests('getColoredPathway', requests):
+            fname = os.path.join(self._keggroom,path)
+            fname = fname+'.png'
+            fOut = open(fname,'w')
+            fOut.write(result)
+            fOut.close()
+            self.pics.append(fname)
+
     def getWebPages(self):
         # TODO: nicer web pages
         legend = self.copyLegend()
@@ -1466,37 +1410,11 @@ class MapsFetcher(BaseKegg):
             self.webpages.append(fname)
     
     def getPages(self):
-        for piece in get_span(self.colors, self.numThreads):
-            if self.killed:
-                logger.debug('Exiting for a kill signal')
-                return
-            
-            self.cleanHandlers()
-            self._substatus += self.numThreads
-            if self._substatus > self._maxsubstatus:
-                self._substatus = self._maxsubstatus
-            self.updateStatus(sub=True)
-            
-            threads = []
-            for kmap in piece:
-                path = kmap.path
-                objs,colors = kmap.getAll()
-                
-                obj = threading.Thread(
-                        target = self.handlers[piece.index(kmap)].getURLColoredPathway,
-                        args = (path,objs,colors,))
-                obj.start()
-                threads.append(obj)
-            time.sleep(0.01)
-            while len(threads) > 0:
-                for thread in threads:
-                    if not thread.isAlive():
-                        threads.remove(thread)
-            for handler in self.handlers:
-                if not handler.result:
-                    continue
-                self.pages.append(handler.result)
-    
+        requests = [(kmap.path,) + kmap.getAll() for kmap in self.colors]
+        for path, result in self.iterRequests('getURLColoredPathway',
+                                              requests):
+            self.pages.append(result)
+
     def run(self):
         self.updateStatus()
         self.makeRoom()
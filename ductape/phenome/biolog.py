@@ -17,6 +17,7 @@ from ductape.phenome.clustering import mean, kmeans
 from ductape.phenome.fitting import fitData, getFlex, getPlateau
 from scipy.integrate import trapz
 from matplotlib import cm
+from itertools import chain, groupby
 import Queue
 import csv
 import logging
@@ -62,6 +63,10 @@ zeroPlates = ['PM01','PM02A','PM03B','PM04A','PM05',
               'PM06','PM07','PM08','PM03B','PM04A']
 zeroWell = 'A01'
 
+# Signal cube time resolution (hours): the plates are read every 15 minutes,
+# each one at slightly different times
+cubeResolution = 0.25
+
 ################################################################################
 # Classes
 
@@ -1781,3 +1786,180 @@ def getPlates(signals, nonmean=False):
     
     for plate in dExp.itervalues():
         yield plate
+        
+def getOrderedSinglePlates(binput, nonmean=False):
+    '''
+    Takes signals or wells from the storage, ordered by plate_id, org_id and
+    replica, and assembles the SinglePlates on the fly
+    Only the rows of the current SinglePlate are kept in memory
+    NB it is a generator
+    '''
+    binput = iter(binput)
+    try:
+        first = binput.next()
+    except StopIteration:
+        return
+    binput = chain([first], binput)
+    
+    if hasattr(first, "times"):
+        key = lambda w: (w.plate_id, w.org_id, w.replica)
+        for k, rows in groupby(binput, key):
+            for splate in getSinglePlatesFromSignals(rows):
+                yield splate
+    elif nonmean:
+        key = lambda w: (w.plate_id, w.org_id, w.replica)
+        for k, rows in groupby(binput, key):
+            for splate in getSinglePlatesFromActivity(rows, nonmean):
+                yield splate
+    else:
+        # The replicas have to be averaged together
+        key = lambda w: (w.plate_id, w.org_id)
+        for k, rows in groupby(binput, key):
+            for splate in getSinglePlatesFromActivity(rows, nonmean):
+                yield splate
+                
+def getOrderedPlates(signals, nonmean=False):
+    '''
+    Takes signals or wells from the storage, ordered by plate_id, org_id and
+    replica, and returns a series of Plates objects, built one at a time
+    NB it is a generator
+    '''
+    for plate_id, splates in groupby(getOrderedSinglePlates(signals, nonmean),
+                                     lambda p: p.plate_id):
+        plate = Plate(plate_id)
+        for splate in splates:
+            plate.addData(splate.strain, splate)
+        yield plate
+        
+def getTimeSteps(times, resolution=cubeResolution):
+    '''
+    Takes a bunch of times (hours) and returns their time steps
+    at the desired resolution
+    '''
+    return [int(round(float(t) / resolution)) for t in times]
+
+def getCubeIndex(signals, resolution=cubeResolution):
+    '''
+    Takes a bunch of signals taken from the DB and returns the index of the
+    signal cube (plate x well x strain x replica x time) as a dictionary
+    of numpy arrays; None is returned if there are no signals
+    The times are rounded to the resolution (hours), so that the plates
+    read at slightly different times share the time axis
+    '''
+    plates, wells, strains, replicas, steps = set(), set(), set(), set(), set()
+    for well in signals:
+        plates.add(well.plate_id)
+        wells.add(well.well_id)
+        strains.add(well.org_id)
+        replicas.add(int(well.replica))
+        steps.update(getTimeSteps(well.times.split('_'), resolution))
+    
+    if len(plates) == 0:
+        return None
+    
+    return {'plates':np.array(sorted(plates)),
+            'wells':np.array(sorted(wells)),
+            'strains':np.array(sorted(strains)),
+            'replicas':np.array(sorted(replicas), dtype=np.int32),
+            'times':np.array(sorted(steps), dtype=np.float64) * resolution,
+            'resolution':np.array(resolution, dtype=np.float64)}
+
+def writeCube(signals, index, prefix='phenome_cube'):
+    '''
+    Takes a bunch of signals taken from the DB and their index
+    (see getCubeIndex) and writes a float32 signal cube
+    (plate x well x strain x replica x time) to prefix.npy
+    and its index to prefix_index.npz; missing values are NaN
+    The times are rounded to the index resolution: the original times
+    are not stored. If two times of a well fall in the same time step,
+    the last one is kept
+    The cube is filled on disk, so it can be bigger than the memory
+    Returns the cube shape
+    '''
+    resolution = float(index['resolution'])
+    
+    dIdx = {}
+    for key in ['plates', 'wells', 'strains', 'replicas']:
+        dIdx[key] = dict([(v, i) for i, v in enumerate(index[key].tolist())])
+    dIdx['times'] = dict([(v, i) for i, v in
+                          enumerate(getTimeSteps(index['times'], resolution))])
+    
+    shape = tuple([len(index[key]) for key in ['plates', 'wells', 'strains',
+                                               'replicas', 'times']])
+    cube = np.lib.format.open_memmap(prefix + '.npy', mode='w+',
+                                     dtype=np.float32, shape=shape)
+    cube[:] = np.nan
+    
+    for well in signals:
+        p = dIdx['plates'][well.plate_id]
+        w = dIdx['wells'][well.well_id]
+        s = dIdx['strains'][well.org_id]
+        r = dIdx['replicas'][int(well.replica)]
+        t = [dIdx['times'][x]
+             for x in getTimeSteps(well.times.split('_'), resolution)]
+        cube[p, w, s, r, t] = [float(x) for x in well.signals.split('_')]
+    
+    cube.flush()
+    del cube
+    
+    np.savez(prefix + '_index.npz', **index)
+    
+    return shape
+
+def loadCube(prefix='phenome_cube'):
+    '''
+    Opens a signal cube created by writeCube
+    The cube is memory-mapped (read only), the index is a dictionary
+    Returns cube, index
+    '''
+    cube = np.load(prefix + '.npy', mmap_mode='r')
+    index = dict(np.load(prefix + '_index.npz').items())
+    
+    return cube, index
+
+def getPlatesFromCube(prefix='phenome_cube', plates=[], strains=[]):
+    '''
+    Takes a signal cube created by writeCube and returns a series of
+    Plates objects (optionally only some plates and strains)
+    The signal times are the ones of the cube time axis, that is the
+    original times rounded to the cube resolution (see getCubeIndex)
+    The cube is memory-mapped, each Plate is read only when requested
+    NB it is a generator
+    '''
+    cube, index = loadCube(prefix)
+    times = index['times']
+    
+    for i, plate_id in enumerate(index['plates'].tolist()):
+        if len(plates) > 0 and plate_id not in plates:
+            continue
+        
+        plate = Plate(plate_id)
+        
+        for j, strain in enumerate(index['strains'].tolist()):
+            if len(strains) > 0 and strain not in strains:
+                continue
+            
+            for k, replica in enumerate(index['replicas'].tolist()):
+                data = np.array(cube[i, :, j, k, :])
+                if np.isnan(data).all():
+                    continue
+                
+                splate = SinglePlate()
+                splate.plate_id = plate_id
+                splate.strain = strain
+                splate.replica = replica
+                
+                for w, well_id in enumerate(index['wells'].tolist()):
+                    present = ~np.isnan(data[w])
+                    if not present.any():
+                        continue
+                    
+                    well = Well(plate_id, well_id)
+                    for hour, signal in zip(times[present], data[w][present]):
+                        well.addSignal(float(hour), float(signal))
+                    splate.addWell(well)
+                
+                plate.addData(strain, splate)
+        
+        if len(plate.strains) > 0:
+            yield plate
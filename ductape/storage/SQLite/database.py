@@ -7,8 +7,10 @@ Storage library
 SQLite Database wrappers
 """
 from Bio import SeqIO
-from ductape.storage.SQLite.dbstrings import dbcreate, dbboost
+from contextlib import contextmanager
+from ductape.storage.SQLite.dbstrings import dbcreate, dbprofiles
 from ductape.common.utils import get_span
+import hashlib
 import logging
 import sqlite3
 import time
@@ -20,6 +22,13 @@ __author__ = "Marco Galardini"
 
 logger = logging.getLogger('ductape.database')
 
+################################################################################
+# Constants
+
+# Seconds to wait for a lock held by another process (i.e. a concurrent
+# dgenome/dphenome run on the same project)
+dbtimeout = 120
+
 ################################################################################
 # Classes
 
@@ -36,16 +45,36 @@ class Row(object):
 class DBBase(object):
     '''
     Class DB
-    General DB handler 
+    General DB handler
+    The PRAGMA profile (default, bulk, read) is applied on each connection
     '''
-    def __init__(self, dbname='storage'):
+    def __init__(self, dbname='storage', profile='default'):
         self.dbname = dbname
+        self.profile = profile
         self.connection = None
         self.cursor = None
         self.connect()
     
     def connect(self):
-        self.connection = sqlite3.connect(self.dbname)
+        self.connection = sqlite3.connect(self.dbname, timeout=dbtimeout)
+        self.setProfile('default')
+        if self.profile != 'default':
+            self.setProfile(self.profile)
+    
+    def setProfile(self, profile):
+        '''
+        Apply a PRAGMA profile to the current connection
+        '''
+        if profile not in dbprofiles:
+            logger.warning('Unknown DB profile %s'%profile)
+            return
+        
+        with self.connection as conn:
+            for pragma in dbprofiles[profile]:
+                try:
+                    conn.execute(pragma)
+                except sqlite3.Error, e:
+                    logger.debug('Could not apply %s (%s)'%(pragma, e))
         
     def getCursor(self):
         if not self.connection:
@@ -77,20 +106,42 @@ class DBBase(object):
 
         return True
     
+    @contextmanager
     def boost(self):
         '''
-        The current connection is boosted
+        The current connection is boosted (bulk-load profile) inside
+        the with block; the previous PRAGMA values are then restored,
+        so that the following writes are crash-safe again
         '''
+        saved = []
         with self.connection as conn:
-            conn.execute(dbboost)
+            for pragma in dbprofiles['bulk']:
+                name = pragma.split()[1]
+                try:
+                    value = conn.execute('PRAGMA %s;'%name).fetchone()
+                except sqlite3.Error:
+                    continue
+                if value is not None:
+                    saved.append('PRAGMA %s = %s;'%(name, value[0]))
+        
+        self.setProfile('bulk')
+        try:
+            yield
+        finally:
+            with self.connection as conn:
+                for pragma in saved:
+                    try:
+                        conn.execute(pragma)
+                    except sqlite3.Error, e:
+                        logger.debug('Could not apply %s (%s)'%(pragma, e))
     
 class Project(DBBase):
     '''
     Class Project
     Handles projects data
     '''
-    def __init__(self, dbname='storage'):
-        DBBase.__init__(self, dbname)
+    def __init__(self, dbname='storage', profile='default'):
+        DBBase.__init__(self, dbname, profile)
         
         self.name = None
         self.description = None
@@ -241,8 +292,8 @@ class Organism(DBBase):
     Class Organism
     Handles the addition and updates on organisms used by the program
     ''' 
-    def __init__(self, dbname='storage'):
-        DBBase.__init__(self, dbname)
+    def __init__(self, dbname='storage', profile='default'):
+        DBBase.__init__(self, dbname, profile)
         
     def __len__(self):
         return self.howMany()
@@ -522,8 +573,8 @@ class Genome(DBBase):
     Class Genome
     Handles the addition and updates on Genomic data used by the program
     ''' 
-    def __init__(self, dbname='storage'):
-        DBBase.__init__(self, dbname)
+    def __init__(self, dbname='storage', profile='default'):
+        DBBase.__init__(self, dbname, profile)
     
     def resetProject(self):
         '''
@@ -593,10 +644,8 @@ class Genome(DBBase):
             logger.warning('Organism %s is not present yet!'%org_id)
             raise Exception('This organism (%s) is not present yet!'%org_id)
         
-        self.boost()
-        
         i = 0
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for s in SeqIO.parse(open(pfile),'fasta'):
                 conn.execute('insert or replace into protein values (?,?,?,?);',
                          [s.id,org_id,s.description,str(s.seq),])
@@ -652,6 +701,42 @@ class Genome(DBBase):
                                 Alphabet.IUPAC.ExtendedIUPACProtein()),
                             id = prot.prot_id)
     
+    def getProteomeChecksum(self, org_id):
+        '''
+        Get a checksum of all the proteins from a specific organism
+        '''
+        with self.connection as conn:
+            cursor=conn.execute('''select prot_id, sequence from protein
+                                    where org_id = ?
+                                    order by rowid;''',[org_id,])
+        
+        checksum = hashlib.sha1()
+        for prot_id, sequence in cursor:
+            checksum.update('%s\t%s\n'%(prot_id, sequence))
+        return checksum.hexdigest()
+    
+    def writeProteome(self, org_id, fname, exclude=set()):
+        '''
+        Write all the proteins from a specific organism in fasta format
+        Plain strings are written, no SeqRecord objects are involved
+        The prot_ids in exclude are skipped
+        Returns the number of proteins written
+        '''
+        with self.connection as conn:
+            cursor=conn.execute('''select prot_id, sequence from protein
+                                    where org_id = ?
+                                    order by rowid;''',[org_id,])
+        
+        i = 0
+        fout = open(fname, 'w')
+        for prot_id, sequence in cursor:
+            if prot_id in exclude:
+                continue
+            fout.write('>%s\n%s\n'%(prot_id, sequence))
+            i += 1
+        fout.close()
+        return i
+    
     def howMany(self, org_id):
         '''
         How many proteins for my organism?
@@ -681,8 +766,6 @@ class Genome(DBBase):
     def addKOs(self, kos):
         oCheck = Kegg(self.dbname)
         
-        self.boost()
-        
         for prot_id,ko_id in kos:
             if not self.isProt(prot_id):
                 logger.warning('Protein %s is not present yet!'%prot_id)
@@ -691,11 +774,52 @@ class Genome(DBBase):
                 logger.warning('KO %s is not present yet!'%'ko:'+ko_id)
                 raise Exception('This KO (%s) is not present yet!'%'ko:'+ko_id)
         
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for prot_id,ko_id in kos:
                 conn.execute('insert or replace into mapko values (?,?);',
                              [prot_id,'ko:'+ko_id,])
     
+    def getMutantShared(self, mut_id, ref_id):
+        '''
+        Get the mutant proteins that are also present in the reference
+        (same prot_id or same sequence)
+        '''
+        query = '''
+                select distinct mp.prot_id
+                from protein mp, protein rp
+                where mp.org_id = ?
+                and rp.org_id = ?
+                and (mp.prot_id = rp.prot_id
+                    or mp.sequence = rp.sequence);
+                '''
+        
+        with self.connection as conn:
+            cursor=conn.execute(query,[mut_id,ref_id,])
+        
+        return set([str(x[0]) for x in cursor])
+    
+    def getMutantKOs(self, mut_id, ref_id):
+        '''
+        Get the KOs of the reference proteins that are also present
+        in the mutant, as (mutant prot_id, ko_id) tuples
+        The ko_id is returned without the "ko:" prefix, as in addKOs
+        '''
+        query = '''
+                select distinct mp.prot_id, m.ko_id
+                from protein mp, protein rp, mapko m
+                where mp.org_id = ?
+                and rp.org_id = ?
+                and (mp.prot_id = rp.prot_id
+                    or mp.sequence = rp.sequence)
+                and m.prot_id = rp.prot_id;
+                '''
+        
+        with self.connection as conn:
+            cursor=conn.execute(query,[mut_id,ref_id,])
+        
+        return [(str(prot_id), str(ko_id).replace('ko:', ''))
+                for prot_id, ko_id in cursor]
+    
     def getKO(self, prot_id):
         with self.connection as conn:
             cursor=conn.execute('select * from mapko where prot_id = ?;',
@@ -727,11 +851,9 @@ class Genome(DBBase):
                 logger.warning('Protein %s is not present yet!'%prot_id)
                 raise Exception('This Protein (%s) is not present yet!'%prot_id)
         
-        self.boost()
-        
         # Go for it!
         i = 0
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for group_id in orthologs:
                 for prot_id in orthologs[group_id]:
                     conn.execute('insert or replace into ortholog values (?,?);',
@@ -926,17 +1048,15 @@ class Kegg(DBBase):
     Class Kegg
     Handles all the data about Kegg entries
     '''
-    def __init__(self, dbname='storage'):
-        DBBase.__init__(self, dbname)
+    def __init__(self, dbname='storage', profile='default'):
+        DBBase.__init__(self, dbname, profile)
     
     def addDraftKOs(self, ko):
         '''
         Add new KOs (ignoring errors if they are already present)
         the input is a list, so no details about this KOs are there yet
         '''
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for ko_id in ko:
                 conn.execute('insert or replace into ko (`ko_id`) values (?);',
                      ('ko:'+ko_id,))
@@ -947,9 +1067,7 @@ class Kegg(DBBase):
         the input is a dictionary
         ko_id --> name, description
         '''
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for ko_id,values in ko.iteritems():
                 name = values[0]
                 if len(values) > 1:
@@ -976,9 +1094,7 @@ class Kegg(DBBase):
                     raise Exception('This reaction (%s) is not present yet!'
                                 %re_id)
         
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for ko_id in koreact:
                 for re_id in koreact[ko_id]:
                     conn.execute('insert or ignore into ko_react values (?,?);',
@@ -1072,9 +1188,7 @@ class Kegg(DBBase):
         the input is a dictionary
         re_id --> name, description
         '''
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for re_id, values in react.iteritems():
                 name = values[0]
                 if len(values) > 1:
@@ -1101,9 +1215,7 @@ class Kegg(DBBase):
                     raise Exception('This compound (%s) is not present yet!'
                                 %co_id)
         
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for re_id in reactcomp:
                 for co_id in reactcomp[re_id]:
                     conn.execute('insert or ignore into react_comp values (?,?);',
@@ -1126,9 +1238,7 @@ class Kegg(DBBase):
                     raise Exception('This reaction (%s) is not present yet!'
                                 %re_id)
         
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for co_id in compreact:
                 for re_id in compreact[co_id]:
                     conn.execute('insert or ignore into react_comp values (?,?);',
@@ -1182,9 +1292,7 @@ class Kegg(DBBase):
         the input is a dictionary
         co_id --> name, description
         '''
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for co_id, values in co.iteritems():
                 name = values[0]
                 if len(values) > 1:
@@ -1224,9 +1332,7 @@ class Kegg(DBBase):
         the input is a dictionary
         path_id --> name, description
         '''
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for path_id, values in path.iteritems():
                 name = values[0]
                 if len(values) > 1:
@@ -1243,9 +1349,7 @@ class Kegg(DBBase):
         the input is a dictionary
         path_id --> html
         '''
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for path_id, html in path.iteritems():
                 if not html:continue
                 html = '\n'.join(html)
@@ -1269,9 +1373,7 @@ class Kegg(DBBase):
                     raise Exception('This reaction (%s) is not present yet!'
                                 %re_id)
         
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for path_id in pathreact:
                 for re_id in pathreact[path_id]:
                     conn.execute('insert or ignore into react_path values (?,?);',
@@ -1308,9 +1410,7 @@ class Kegg(DBBase):
                     raise Exception('This compound (%s) is not present yet!'
                                 %co_id)
         
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for path_id in pathcomp:
                 for co_id in pathcomp[path_id]:
                     conn.execute('insert or ignore into comp_path values (?,?);',
@@ -1327,9 +1427,7 @@ class Kegg(DBBase):
                 raise Exception('This pathway (%s) is not present yet!'
                                 %path_id)
         
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for path_id in pathmap:
                 conn.execute('insert or ignore into pathmap (path_id, html) values (?,?);',
                                  (path_id,'\n'.join(pathmap[path_id]),))
@@ -1345,9 +1443,7 @@ class Kegg(DBBase):
                 raise Exception('This pathway (%s) is not present yet!'
                                 %path_id)
         
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for path_id in pathpic:
                 pic = open(pathpic[path_id])
                 conn.execute('update pathmap set png = ? where path_id = ?;',
@@ -1499,29 +1595,71 @@ class Kegg(DBBase):
         for res in cursor:
             yield Row(res, cursor.description)
             
-    def getReferenceReact(self, mut_id, ref_id):
+    def _getOrgReactMap(self, org_id):
         '''
-        Get reactions from a reference organism (and numerosity)
-        The mutated proteins won't be taken into account
+        Reactions from a defined organism, as a dictionary
+        re_id --> set of prot_ids
         '''
         query = '''
-                select distinct re_id, count(distinct p.prot_id) num
+                select distinct re_id, p.prot_id
                 from ko_react k, mapko m, protein p
                 where k.ko_id = m.ko_id
                 and p.prot_id = m.prot_id
-                and org_id = ?
-                and p.prot_id not in (select prot_id
-                                    from protein
-                                    where org_id = ?)
-                group by re_id
-                order by num DESC;
+                and org_id = ?;
                 '''
         
         with self.connection as conn:
-            cursor=conn.execute(query,[ref_id,mut_id,])
-            
-        for res in cursor:
-            yield Row(res, cursor.description)
+            cursor=conn.execute(query,[org_id,])
+        
+        react = {}
+        for re_id, prot_id in cursor:
+            react[re_id] = react.get(re_id, set())
+            react[re_id].add(prot_id)
+        
+        return react
+    
+    def _getMutantReact(self, mut_id, react):
+        '''
+        Subtract the mutated proteins from the reference reactions
+        Returns a list of (re_id, num), sorted by numerosity
+        '''
+        with self.connection as conn:
+            cursor=conn.execute('''select prot_id from protein
+                                    where org_id = ?;''',[mut_id,])
+        mutated = set([x[0] for x in cursor])
+        
+        reacts = []
+        for re_id, prots in react.iteritems():
+            num = len(prots.difference(mutated))
+            if num > 0:
+                reacts.append((re_id, num))
+        reacts.sort(key=lambda x: x[1], reverse=True)
+        
+        return reacts
+    
+    def getReferenceReact(self, mut_id, ref_id):
+        '''
+        Get reactions from a reference organism (and numerosity)
+        The mutated proteins won't be taken into account
+        '''
+        for res in self._getMutantReact(mut_id, self._getOrgReactMap(ref_id)):
+            yield Row(res, [('re_id',), ('num',)])
+    
+    def getMutantsReferenceReact(self, ref_id, muts):
+        '''
+        Get reactions from a reference organism (and numerosity)
+        for each one of its mutants, without the mutated proteins
+        The reference reactions are fetched only once in this call
+        Returns a dictionary mut_id --> list of Rows
+        '''
+        react = self._getOrgReactMap(ref_id)
+        
+        mutreact = {}
+        for mut_id in muts:
+            mutreact[mut_id] = [Row(res, [('re_id',), ('num',)])
+                                for res in self._getMutantReact(mut_id, react)]
+        
+        return mutreact
             
     def howManyMapped(self, org_id=None, pangenome=''):
         '''
@@ -1802,8 +1940,8 @@ class Biolog(DBBase):
     Class Biolog
     Handles all the data about Biolog entries
     '''
-    def __init__(self, dbname='storage'):
-        DBBase.__init__(self, dbname)
+    def __init__(self, dbname='storage', profile='default'):
+        DBBase.__init__(self, dbname, profile)
     
     def resetProject(self):
         '''
@@ -2067,9 +2205,7 @@ class Biolog(DBBase):
                 logger.warning('Parameters extraction not yet performed!')
                 raise Exception('Parameters extraction not yet performed!')
         
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             if clustered:
                 blist = ['''('%s','%s','%s',%s,
                             %s,%s,%s,%s,%s,%s,
@@ -2223,12 +2359,38 @@ class Biolog(DBBase):
                                     and org_id=?;''',[activity,org_id,])
         return int(cursor.fetchall()[0][0])
     
-    def getAllWells(self):
+    def _filterQuery(self, query, plates=[], orgs=[]):
+        '''
+        Add the plates/organisms filters to a query on a biolog_exp* table
+        Results are ordered by plate_id, org_id, replica
+        Returns the query and its arguments
+        '''
+        where = []
+        args = []
+        if len(plates) > 0:
+            where.append('plate_id in (%s)'%', '.join(['?']*len(plates)))
+            args += list(plates)
+        if len(orgs) > 0:
+            where.append('org_id in (%s)'%', '.join(['?']*len(orgs)))
+            args += list(orgs)
+        
+        if len(where) > 0:
+            query += ' where ' + ' and '.join(where)
+        query += ' order by plate_id, org_id, replica, well_id;'
+        
+        return query, args
+    
+    def getAllWells(self, plates=[], orgs=[]):
         '''
         Get all the wells from the storage
+        The wells are returned in (plate_id, org_id, replica) order
+        If plates and/or orgs are provided, only those are returned
         '''
+        query, args = self._filterQuery('''select * from biolog_exp''',
+                                        plates, orgs)
+        
         with self.connection as conn:
-            cursor=conn.execute('''select * from biolog_exp;''')
+            cursor=conn.execute(query, args)
         
         for res in cursor:
             yield Row(res, cursor.description)
@@ -2241,33 +2403,66 @@ class Biolog(DBBase):
             cursor=conn.execute('select max(max) from biolog_exp;')
         return int(cursor.fetchall()[0][0])
     
-    def getAllSignals(self):
+    def getAllSignals(self, plates=[], orgs=[]):
         '''
         Get all the signals from the storage
+        The signals are returned in (plate_id, org_id, replica) order
+        If plates and/or orgs are provided, only those are returned
         '''
+        query, args = self._filterQuery('''select * from biolog_exp_det''',
+                                        plates, orgs)
+        
         with self.connection as conn:
-            cursor=conn.execute('''select * from biolog_exp_det;''')
+            cursor=conn.execute(query, args)
         
         for res in cursor:
             yield Row(res, cursor.description)
     
-    def getZeroSubtractableSignals(self):
+    def getZeroSubtractablePlates(self, plates=[]):
         '''
-        Get all the signals that can be zero-subtracted
+        Get the plate IDs having at least one well that can be zero-subtracted
+        If plates is provided, only those plates are considered
         '''
+        query = '''select distinct plate_id from biolog_exp
+                   where zero = 0'''
+        if len(plates) > 0:
+            query += '''
+                   and plate_id in (%s)'''%', '.join(['?']*len(plates))
+        query += '''
+                   order by plate_id;'''
+        
         with self.connection as conn:
-            cursor=conn.execute('''select * from biolog_exp where zero = 0;''')
+            cursor=conn.execute(query, list(plates))
         
-        notYet = [Row(res, cursor.description) for res in cursor]
-        for well in notYet:
-            with self.connection as conn:
-                cursor=conn.execute('''select * from biolog_exp_det
-                                    where plate_id=? and well_id=? and org_id=?
-                                    and replica=?;''',
-                                    [well.plate_id,well.well_id,
-                                     well.org_id,well.replica,])
-            for res in cursor:
-                yield Row(res, cursor.description)
+        for res in cursor:
+            yield res[0]
+    
+    def getZeroSubtractableSignals(self, plates=[]):
+        '''
+        Get all the signals that can be zero-subtracted
+        A single join is performed, the signals are returned in plate order
+        (plate_id, org_id, replica) so that each plate can be handled
+        separately
+        If plates is provided, only those plates are considered
+        '''
+        query = '''select d.*
+                   from biolog_exp_det d, biolog_exp e
+                   where d.plate_id = e.plate_id
+                   and d.well_id = e.well_id
+                   and d.org_id = e.org_id
+                   and d.replica = e.replica
+                   and e.zero = 0'''
+        if len(plates) > 0:
+            query += '''
+                   and d.plate_id in (%s)'''%', '.join(['?']*len(plates))
+        query += '''
+                   order by d.plate_id, d.org_id, d.replica, d.well_id;'''
+        
+        with self.connection as conn:
+            cursor=conn.execute(query, list(plates))
+        
+        for res in cursor:
+            yield Row(res, cursor.description)
                 
     def atLeastOneZeroSubtracted(self):
         '''
@@ -2333,9 +2528,7 @@ class Biolog(DBBase):
         Get a list of biolog_ids and move them to the
         "purged wells" zone
         '''
-        self.boost()
-        
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             for w in wells:
                 cursor = conn.execute('''select * from biolog_exp_det
                                 where plate_id=? and well_id=? and org_id=?
@@ -2376,11 +2569,9 @@ class Biolog(DBBase):
         '''
         import copy
         
-        self.boost()
-        
         restored = 0
         
-        with self.connection as conn:
+        with self.boost(), self.connection as conn:
             cursor = conn.execute('''select * from biolog_purged_exp_det;''')
             
             exp_det = copy.deepcopy(cursor.description)
@@ -1,4 +1,12 @@
-dbboost='''PRAGMA cache_size = 20000;'''
+dbprofiles={'default':['PRAGMA journal_mode = WAL;',
+                       'PRAGMA synchronous = NORMAL;'],
+            'bulk':['PRAGMA cache_size = 20000;',
+                    'PRAGMA synchronous = OFF;',
+                    'PRAGMA temp_store = MEMORY;',
+                    'PRAGMA mmap_size = 268435456;'],
+            'read':['PRAGMA cache_size = 20000;',
+                    'PRAGMA temp_store = MEMORY;',
+                    'PRAGMA mmap_size = 268435456;']}
 dbcreate='''
 CREATE TABLE project (
     "name" TEXT NOT NULL,
@@ -21,7 +21,8 @@ logger = logging.getLogger('ductape.terminal')
 ################################################################################
 # Methods
 
-def RunThread(obj):
+def RunThread(obj, poll=None):
+    # poll (if provided) is called periodically from this thread
     # Check terminal log state: if lower then INFO
     # Do not display the progressbars
     progress = True
@@ -53,6 +54,8 @@ def RunThread(obj):
                                 prg = ''
                     if msg.fail:
                         logger.error('Failure! %s'%msg.msg)
+                        if poll is not None:
+                            poll()
                         return False
                     elif not msg.substatus and not sub:
                         logger.info('%s - %s'%(msg.status, msg.msg))
@@ -63,6 +66,9 @@ def RunThread(obj):
                                 'Item %d on %d total'%(msg.substatus, msg.maxsubstatus))
                     sub = False
                     
+            if poll is not None:
+                poll()
+            
             if not obj.isAlive():
                 break
         except KeyboardInterrupt:
@@ -71,5 +77,8 @@ def RunThread(obj):
             obj.join()
             logger.warning('Got keyboard interruption -- Aborted')
             return False
+    
+    if poll is not None:
+        poll()
         
     return True
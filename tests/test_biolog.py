@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Biolog tests
+
+Checks the signal cube write/load round-trip, with plates read
+at slightly different times
+Usage: python -m unittest discover -s tests
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from ductape.phenome.biolog import getCubeIndex, writeCube, loadCube, \
+                                   getPlatesFromCube
+import numpy as np
+import shutil
+import tempfile
+import unittest
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Classes
+
+class Signals(object):
+    '''
+    Signals of a well, as taken from the DB
+    '''
+    def __init__(self, plate_id, well_id, org_id, replica, times, signals):
+        self.plate_id = plate_id
+        self.well_id = well_id
+        self.org_id = org_id
+        self.replica = replica
+        self.times = '_'.join([str(x) for x in times])
+        self.signals = '_'.join([str(x) for x in signals])
+
+class TestCube(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='cube_')
+        self.prefix = os.path.join(self.tmp, 'cube')
+        
+        self.signals = []
+        # Each plate is read at a different offset, every 15 minutes
+        for plate_id, offset in [('PM01', 0.0), ('PM02A', 0.05),
+                                 ('PM03B', 0.1)]:
+            for replica in (1, 2):
+                for well_id in ('A01', 'A02'):
+                    times = [i * 0.25 + offset + replica * 0.01
+                             for i in xrange(97)]
+                    signals = [float(i + replica) for i in xrange(97)]
+                    self.signals.append(Signals(plate_id, well_id, 'strain',
+                                                replica, times, signals))
+        # Shorter run for one well
+        self.signals.append(Signals('PM01', 'A03', 'strain', 1,
+                                    [0.0, 0.25, 0.5], [1.0, 2.0, 3.0]))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+    
+    def test_index(self):
+        index = getCubeIndex(self.signals)
+        self.assertEqual(index['times'].dtype, np.float64)
+        self.assertEqual(list(index['times']), [i * 0.25 for i in xrange(97)])
+        self.assertEqual(list(index['plates']), ['PM01', 'PM02A', 'PM03B'])
+        self.assertEqual(list(index['wells']), ['A01', 'A02', 'A03'])
+        self.assertEqual(list(index['replicas']), [1, 2])
+        self.assertEqual(getCubeIndex([]), None)
+    
+    def test_roundtrip(self):
+        index = getCubeIndex(self.signals)
+        shape = writeCube(self.signals, index, self.prefix)
+        self.assertEqual(shape, (3, 3, 1, 2, 97))
+        
+        cube, index = loadCube(self.prefix)
+        self.assertEqual(cube.shape, shape)
+        self.assertEqual(float(index['resolution']), 0.25)
+        # Only the missing wells are NaN
+        self.assertEqual(np.isnan(cube).sum(), 3 * 2 * 97 - 3)
+        self.assertEqual(list(cube[1, 0, 0, 1, :3]), [2.0, 3.0, 4.0])
+        
+        plates = dict([(p.plate_id, p) for p in
+                       getPlatesFromCube(self.prefix)])
+        self.assertEqual(sorted(plates), ['PM01', 'PM02A', 'PM03B'])
+        splate = plates['PM01'].strains['strain'][0]
+        self.assertEqual(sorted(splate.data), ['A01', 'A02', 'A03'])
+        self.assertEqual(splate.data['A03'].signals,
+                         {0.0:1.0, 0.25:2.0, 0.5:3.0})
+        
+        subset = list(getPlatesFromCube(self.prefix, plates=['PM02A']))
+        self.assertEqual([p.plate_id for p in subset], ['PM02A'])
+    
+    def test_rounded(self):
+        writeCube(self.signals, getCubeIndex(self.signals), self.prefix)
+        
+        # The times read back are the rounded ones
+        plate = list(getPlatesFromCube(self.prefix, plates=['PM02A']))[0]
+        for splate in plate.strains['strain']:
+            signals = splate.data['A01'].signals
+            self.assertEqual(sorted(signals)[:3], [0.0, 0.25, 0.5])
+            self.assertEqual(signals[0.25], 1.0 + splate.replica)
+
+if __name__ == '__main__':
+    unittest.main()
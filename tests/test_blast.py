@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Blast tests
+
+Checks the tabular Blast output parser
+Usage: python -m unittest discover -s tests
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from ductape.genome.blast import iterTabularHits
+import unittest
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Classes
+
+class TestTabularHits(unittest.TestCase):
+    lines = ['# BLASTP 2.2.28+\n',
+             'q1\tK1\t100\t120\t1e-50\t200.0\teco:b0001 thrL; K08278\n',
+             'q1\tK2\t100\t90\t0.5\t30.0\teco:b0002 thrA\twith a tab\n',
+             'q2\tK3\t50\t60\t1e-10\t80.0\teco:b0003 thrB; K00872\n',
+             'truncated\tline\n']
+    
+    def test_groups(self):
+        hits = list(iterTabularHits(self.lines))
+        self.assertEqual([[h.hit for h in x] for x in hits],
+                         [['K1', 'K2'], ['K3']])
+        self.assertEqual(hits[0][1].hit_desc, 'eco:b0002 thrA\twith a tab')
+        self.assertEqual(hits[0][0].query_len, 100)
+        self.assertEqual(hits[0][0].getKO(), 'K08278')
+        self.assertEqual(hits[0][1].getKO(), None)
+    
+    def test_expect(self):
+        hits = list(iterTabularHits(self.lines, expect=1e-5))
+        self.assertEqual([[h.hit for h in x] for x in hits],
+                         [['K1'], ['K3']])
+
+if __name__ == '__main__':
+    unittest.main()
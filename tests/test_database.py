@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Storage tests
+
+Checks the proteome export of a project
+and the reference reactions of its mutants
+Usage: python -m unittest discover -s tests
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from ductape.storage.SQLite.database import DBBase, Organism, Genome, Kegg
+import shutil
+import tempfile
+import unittest
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Classes
+
+class TestProteome(unittest.TestCase):
+    # Not sorted by ID
+    proteins = [('p3', 'MKVLA'), ('p1', 'MSTNP'), ('p2', 'MALWQ')]
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='storage_')
+        self.project = os.path.join(self.tmp, 'test.db')
+        DBBase(self.project).create()
+        Organism(self.project).addOrg('org1')
+        
+        fasta = os.path.join(self.tmp, 'org1.faa')
+        f = open(fasta, 'w')
+        for prot_id, sequence in self.proteins:
+            f.write('>%s\n%s\n'%(prot_id, sequence))
+        f.close()
+        Genome(self.project).addProteome('org1', fasta)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+    
+    def test_order(self):
+        gen = Genome(self.project)
+        fname = os.path.join(self.tmp, 'out.faa')
+        self.assertEqual(gen.writeProteome('org1', fname), 3)
+        # Same order of the original file
+        self.assertEqual(open(fname).read(),
+                         ''.join(['>%s\n%s\n'%x for x in self.proteins]))
+        self.assertEqual([x.id for x in gen.getRecords('org1')],
+                         [x[0] for x in self.proteins])
+    
+    def test_exclude(self):
+        gen = Genome(self.project)
+        fname = os.path.join(self.tmp, 'out.faa')
+        self.assertEqual(gen.writeProteome('org1', fname, exclude=set(['p1'])),
+                         2)
+        self.assertEqual(open(fname).read(), '>p3\nMKVLA\n>p2\nMALWQ\n')
+    
+    def test_checksum(self):
+        gen = Genome(self.project)
+        checksum = gen.getProteomeChecksum('org1')
+        self.assertEqual(gen.getProteomeChecksum('org1'), checksum)
+        
+        fasta = os.path.join(self.tmp, 'changed.faa')
+        open(fasta, 'w').write('>p1\nMSTNPW\n')
+        gen.addProteome('org1', fasta)
+        self.assertNotEqual(gen.getProteomeChecksum('org1'), checksum)
+
+class TestReferenceReact(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='storage_')
+        self.project = os.path.join(self.tmp, 'test.db')
+        DBBase(self.project).create()
+        org = Organism(self.project)
+        org.addOrg('ref')
+        org.addOrg('mut', mutant=True, reference='ref')
+        
+        gen = Genome(self.project)
+        for org_id, proteins in [('ref', ['r1', 'r2', 'r3']), ('mut', ['r2'])]:
+            fasta = os.path.join(self.tmp, '%s.faa'%org_id)
+            f = open(fasta, 'w')
+            for prot_id in proteins:
+                f.write('>%s\nMKVLA\n'%prot_id)
+            f.close()
+            gen.addProteome(org_id, fasta)
+        
+        kegg = Kegg(self.project)
+        kegg.addDraftKOs(['K1', 'K2'])
+        kegg.addKOs({'ko:K1':['k1'], 'ko:K2':['k2']})
+        kegg.addReactions({'rn:R1':['r1'], 'rn:R2':['r2']})
+        kegg.addKOReacts({'ko:K1':['rn:R1'], 'ko:K2':['rn:R2']})
+        gen.addKOs([('r1', 'K1'), ('r2', 'K1')])
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+    
+    def getReact(self, kegg):
+        return dict([(x.re_id, x.num)
+                     for x in kegg.getReferenceReact('mut', 'ref')])
+    
+    def test_mutated(self):
+        kegg = Kegg(self.project)
+        # r2 is mutated
+        self.assertEqual(self.getReact(kegg), {'rn:R1':1})
+        self.assertEqual(dict([(x.re_id, x.num) for x in
+                               kegg.getMutantsReferenceReact('ref',
+                                                        ['mut'])['mut']]),
+                         {'rn:R1':1})
+    
+    def test_updated(self):
+        kegg = Kegg(self.project)
+        self.assertEqual(self.getReact(kegg), {'rn:R1':1})
+        
+        # New KOs for the reference are seen by the same object
+        Genome(self.project).addKOs([('r3', 'K1'), ('r3', 'K2')])
+        self.assertEqual(self.getReact(kegg), {'rn:R1':2, 'rn:R2':1})
+
+if __name__ == '__main__':
+    unittest.main()
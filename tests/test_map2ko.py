@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Map2KO tests
+
+Checks the parsing of the reverse Blast query IDs
+Usage: python -m unittest discover -s tests
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from ductape.genome.map2KO import LocalSearch
+import unittest
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Classes
+
+class TestReverseIndex(unittest.TestCase):
+    def setUp(self):
+        self.search = LocalSearch('query.faa', 'target.faa')
+        self.search._reventries = [(False, 'eco:b0001'),
+                                   (True, 'eco:b0002')]
+    
+    def test_plain(self):
+        self.assertEqual(self.search._getReverseIndex('q0'), 0)
+        self.assertEqual(self.search._getReverseIndex('q1'), 1)
+    
+    def test_decorated(self):
+        self.assertEqual(self.search._getReverseIndex('lcl|q1'), 1)
+        self.assertEqual(self.search._getReverseIndex('gi|q1'), 1)
+        self.assertEqual(self.search._getReverseIndex('gnl|BL_ORD_ID|q0'), 0)
+    
+    def test_unexpected(self):
+        for query in ['1', 'gi|1', 'q', 'qx', 'q2', 'eco:b0001', '']:
+            self.assertEqual(self.search._getReverseIndex(query), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Pangenome tests
+
+Checks the ortholog groups bookkeeping, and that a resumed, updated or
+prefiltered pangenome is the same as the one computed in a single run
+(synthetic proteomes, Smith-Waterman backend: no Blast involved)
+Usage: python -m unittest discover -s tests
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from ductape.genome.blast import cacheenv
+from ductape.genome.pangenome import PanGenomer, OrthologGroups
+import random
+import shutil
+import tempfile
+import unittest
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Constants
+
+alphabet = 'ACDEFGHIKLMNPQRSTVWY'
+
+################################################################################
+# Methods
+
+def mutate(seq, rate=0.15):
+    return ''.join([random.choice(alphabet) if random.random() < rate
+                    else aa for aa in seq])
+
+def randomProtein(minlen, maxlen):
+    return ''.join([random.choice(alphabet)
+                    for i in xrange(random.randint(minlen, maxlen))])
+
+def getGroups(pangenomer):
+    '''
+    Ortholog groups as sorted lists of proteins (names may differ)
+    '''
+    return sorted([sorted(x) for x in pangenomer.orthologs.values()])
+
+################################################################################
+# Classes
+
+class InterruptedPanGenomer(PanGenomer):
+    '''
+    PanGenomer killed after a few ortholog groups
+    '''
+    stopAfter = 10
+    
+    def _saveGroup(self, handle, group):
+        PanGenomer._saveGroup(self, handle, group)
+        if len(self.groups) >= self.stopAfter:
+            self.killed = True
+
+class TestOrthologGroups(unittest.TestCase):
+    def test_groups(self):
+        groups = OrthologGroups()
+        self.assertTrue(groups.newGroup('1', 'a1', 'A'))
+        self.assertTrue(groups.addProtein('1', 'b1', 'B'))
+        self.assertTrue(groups.addProtein('1', 'b2', 'B'))
+        self.assertTrue(groups.newGroup('2', 'a2', 'A'))
+        
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(sorted(groups), ['1', '2'])
+        self.assertTrue('b1' in groups)
+        self.assertFalse('c1' in groups)
+        self.assertEqual(groups.getGroup('b2'), '1')
+        self.assertEqual(groups.getGroup('c1'), None)
+        self.assertEqual(groups.getProteins('1'), ['a1', 'b1', 'b2'])
+        self.assertEqual(groups.getOrganisms('1'), set(['A', 'B']))
+        self.assertTrue(groups.hasOrganism('1', 'B'))
+        self.assertFalse(groups.hasOrganism('2', 'B'))
+    
+    def test_duplicates(self):
+        groups = OrthologGroups()
+        groups.newGroup('1', 'a1', 'A')
+        # Already assigned proteins, existing groups
+        self.assertFalse(groups.addProtein('1', 'a1', 'A'))
+        self.assertFalse(groups.newGroup('2', 'a1', 'A'))
+        self.assertFalse(groups.newGroup('1', 'a2', 'A'))
+        self.assertEqual(groups.getProteins('1'), ['a1'])
+        self.assertEqual(len(groups), 1)
+
+class TestPackPanGenome(unittest.TestCase):
+    def test_paralogs(self):
+        pangenomer = PanGenomer(['A', 'B', 'C'])
+        # Paralogs from the same organism (i.e. from the BBH graph)
+        pangenomer.groups.newGroup('1', 'a1', 'A')
+        pangenomer.groups.addProtein('1', 'a2', 'A')
+        pangenomer.groups.addProtein('1', 'b1', 'B')
+        pangenomer.groups.newGroup('2', 'a3', 'A')
+        pangenomer.groups.addProtein('2', 'a4', 'A')
+        pangenomer.groups.newGroup('3', 'a5', 'A')
+        pangenomer.groups.addProtein('3', 'b2', 'B')
+        pangenomer.groups.addProtein('3', 'c1', 'C')
+        pangenomer.packPanGenome()
+        
+        self.assertEqual(pangenomer.core, ['3'])
+        self.assertEqual(pangenomer.accessory, ['1'])
+        self.assertEqual(pangenomer.unique, ['2'])
+
+class TestPanGenome(unittest.TestCase):
+    def setUp(self):
+        random.seed(5)
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp(prefix='pangenome_')
+        os.chdir(self.tmp)
+        # The shared Blast DBs cache is left alone
+        self.cache = os.environ.get(cacheenv)
+        os.environ[cacheenv] = ''
+        
+        core = [randomProtein(40, 100) for i in xrange(25)]
+        self.organisms = []
+        for org in 'XYZ':
+            fname = os.path.join(self.tmp, org)
+            f = open(fname, 'w')
+            for i, seq in enumerate(core):
+                # Some proteins are missing in one organism
+                if org == 'Z' and i%4 == 0:
+                    continue
+                f.write('>%s%d\n%s\n'%(org.lower(), i, mutate(seq)))
+            # Unique protein
+            f.write('>%sx\n%s\n'%(org.lower(), randomProtein(60, 60)))
+            f.close()
+            self.organisms.append(fname)
+        
+        self.full = PanGenomer(self.organisms, backend='sw')
+        self.full.run()
+    
+    def tearDown(self):
+        os.chdir(self.cwd)
+        if self.cache is None:
+            del os.environ[cacheenv]
+        else:
+            os.environ[cacheenv] = self.cache
+        shutil.rmtree(self.tmp, True)
+    
+    def test_full(self):
+        groups = getGroups(self.full)
+        self.assertEqual(len(groups), 29)
+        self.assertTrue(['x1', 'y1', 'z1'] in groups)
+        self.assertTrue(['x0', 'y0'] in groups)
+        self.assertTrue(['xx'] in groups)
+    
+    def test_resume(self):
+        interrupted = InterruptedPanGenomer(self.organisms, backend='sw')
+        interrupted.run()
+        self.assertEqual(len(interrupted.orthologs), 10)
+        # The checkpoint is kept (header plus the groups done)
+        self.assertEqual(len(open(interrupted._checkpoint).readlines()), 11)
+        
+        resumed = PanGenomer(self.organisms, backend='sw', recover=True)
+        resumed.run()
+        self.assertEqual(resumed.orthologs, self.full.orthologs)
+    
+    def test_manifest(self):
+        def resume(organisms, recover=True):
+            pangenomer = PanGenomer(organisms, backend='sw', recover=recover)
+            pangenomer.makeRoom()
+            pangenomer._checkManifest()
+            return os.path.join(pangenomer._pangenomeroom, '0_1.tab')
+        
+        out = resume(self.organisms)
+        open(out, 'w').write('\n')
+        # Same organisms and parameters: the outputs are reused
+        resume(self.organisms)
+        self.assertTrue(os.path.exists(out))
+        # Different order: index-named outputs are discarded
+        resume(self.organisms[::-1])
+        self.assertFalse(os.path.exists(out))
+        
+        open(out, 'w').write('\n')
+        resume(self.organisms[::-1], recover=False)
+        self.assertFalse(os.path.exists(out))
+        
+        # Changed proteome
+        resume(self.organisms)
+        open(out, 'w').write('\n')
+        open(self.organisms[0], 'a').write('>new\nMKVLAAGLW\n')
+        resume(self.organisms)
+        self.assertFalse(os.path.exists(out))
+    
+    def test_update(self):
+        first = PanGenomer(self.organisms[:2], backend='sw')
+        first.run()
+        
+        updated = PanGenomer(self.organisms, backend='sw',
+                             pangenome=first.orthologs)
+        updated.run()
+        self.assertEqual(getGroups(updated), getGroups(self.full))
+    
+    def test_prefilter(self):
+        filtered = PanGenomer(self.organisms, backend='sw', prefilter=True)
+        filtered.run()
+        self.assertEqual(getGroups(filtered), getGroups(self.full))
+        self.assertTrue(filtered.prefilterStats['avoided'] > 0)
+        # At least a recall check for each organisms pair
+        self.assertEqual(filtered.prefilterStats['checked'],
+                         len(filtered._filtered))
+        
+        checked = PanGenomer(self.organisms, backend='sw',
+                             prefiltercheck=True)
+        checked.run()
+        self.assertEqual(checked.prefilterStats['avoided'], 0)
+        self.assertEqual(checked.prefilterStats['missed'], 0)
+        self.assertEqual(checked.orthologs, self.full.orthologs)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Smith-Waterman backend tests
+
+Checks the vectorized Gotoh recursion against a naive implementation,
+and the tabular output of the backend against the Blast parser
+Usage: python -m unittest discover -s tests
+"""
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from Bio.SubsMat import MatrixInfo
+from ductape.genome.blast import Blaster, iterTabularHits
+from ductape.genome import smithwaterman as sw
+import random
+import shutil
+import tempfile
+import unittest
+
+__author__ = "Marco Galardini"
+
+################################################################################
+# Constants
+
+alphabet = 'ACDEFGHIKLMNPQRSTVWY'
+
+################################################################################
+# Methods
+
+def gotoh(query, target, matrix, gapopen=sw.gapopen, gapextend=sw.gapextend):
+    '''
+    Best local alignment score, one cell at a time (reference implementation)
+    '''
+    m, n = len(query), len(target)
+    minf = -(1 << 30)
+    H = [[0] * (n + 1) for i in xrange(m + 1)]
+    E = [[minf] * (n + 1) for i in xrange(m + 1)]
+    F = [[minf] * (n + 1) for i in xrange(m + 1)]
+    best = 0
+    for i in xrange(1, m + 1):
+        for j in xrange(1, n + 1):
+            E[i][j] = max(E[i-1][j] - gapextend,
+                          H[i-1][j] - gapopen - gapextend)
+            F[i][j] = max(F[i][j-1] - gapextend,
+                          H[i][j-1] - gapopen - gapextend)
+            H[i][j] = max(0, H[i-1][j-1] + matrix[query[i-1]][target[j-1]],
+                          E[i][j], F[i][j])
+            best = max(best, H[i][j])
+    return best
+
+def randomProtein(minlen, maxlen):
+    return ''.join([random.choice(alphabet)
+                    for i in xrange(random.randint(minlen, maxlen))])
+
+def writeFasta(fname, proteins):
+    f = open(fname, 'w')
+    for i, seq in enumerate(proteins):
+        f.write('>prot%d protein number %d\n%s\n'%(i, i, seq))
+    f.close()
+
+################################################################################
+# Classes
+
+class TestAlign(unittest.TestCase):
+    def setUp(self):
+        random.seed(3)
+        self.tmp = tempfile.mkdtemp(prefix='sw_')
+        self.matrix = sw.getMatrix(MatrixInfo.blosum62)
+        
+        self.proteins = [randomProtein(5, 40) for i in xrange(20)]
+        # Related sequences, with an insertion and a deletion
+        base = self.proteins[0]
+        self.proteins.append(base[:10] + 'WWW' + base[10:])
+        self.proteins.append(base[:5] + base[9:])
+        # Unknown residues
+        self.proteins.append('MKXXBZLLV')
+        
+        self.fasta = os.path.join(self.tmp, 'proteins.faa')
+        writeFasta(self.fasta, self.proteins)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp, True)
+    
+    def test_naive(self):
+        sdb = sw.SWDatabase(self.fasta)
+        queries = self.proteins[:3] + [randomProtein(10, 30)
+                                       for i in xrange(3)]
+        for query in queries:
+            codes = list(sw.encode(query))
+            expected = [gotoh(codes, list(sw.encode(target)), self.matrix)
+                        for target in self.proteins]
+            self.assertEqual(list(sw.align(sw.encode(query), sdb,
+                                           self.matrix)),
+                             expected)
+    
+    def test_empty(self):
+        sdb = sw.SWDatabase(self.fasta)
+        scores = sw.align(sw.encode(''), sdb, self.matrix)
+        self.assertEqual(list(scores), [0] * len(self.proteins))
+    
+    def test_search(self):
+        blaster = Blaster('sw')
+        db = os.path.join(self.tmp, 'db')
+        self.assertTrue(blaster.createDB(self.fasta, 'prot', db))
+        
+        query = '>query\n%s\n'%self.proteins[0]
+        out = blaster.runBlastPipe(query, db, evalue=10,
+                                   additional='-max_target_seqs 3')
+        hits = list(iterTabularHits(out.splitlines(True)))
+        self.assertEqual(len(hits), 1)
+        self.assertTrue(0 < len(hits[0]) <= 3)
+        # Best hit first: the sequence itself
+        self.assertEqual(hits[0][0].query_id, 'query')
+        self.assertEqual(hits[0][0].hit, 'prot0')
+        self.assertEqual(hits[0][0].hit_desc, 'prot0 protein number 0')
+        self.assertEqual(sorted(hits[0], key=lambda h: -h.bits), hits[0])
+        
+        self.assertEqual(blaster.fetchSequence(db, 'lcl|prot1'),
+                         '>prot1 protein number 1\n%s\n'%self.proteins[1])
+
+if __name__ == '__main__':
+    unittest.main()